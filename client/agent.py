@@ -1,60 +1,234 @@
 import ConfigParser
 import io
 import logging
+import os
+import random
 import shutil
+import socket
 import sys
 import tempfile
+import threading
+from Queue import Queue, Empty
+from time import time
 
-from time import sleep
-from urllib import urlencode
-from urllib2 import urlopen, URLError
-
+from client.http_client import HttpClient
 from client.model import ResultDirectory
 
+POLL_TIMEOUT = 30
+UPLOAD_TIMEOUT = 300
+
 log = logging.getLogger(__name__)
 
 
+class Slot:
+    def __init__(self, index, directory, lockfile):
+        self.index = index
+        self.directory = directory
+        self.lockfile = lockfile
+
+    def __repr__(self):
+        return "Slot(index=%d, directory=%s)" % (self.index, self.directory)
+
+
+class PollScheduler:
+    """Decides how long to wait before the next poll: not at all after a job, backing off exponentially with jitter
+    while the queue is empty or the server cannot be reached"""
+
+    def __init__(self, initial_interval=1, max_interval=60, factor=2, jitter=0.5, long_poll=False):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.long_poll = long_poll
+        self.interval = 0
+
+    def job_found(self):
+        self.interval = 0
+        return 0
+
+    def empty(self):
+        # A long-poll already waited on the server for a job to show up
+        if self.long_poll:
+            self.interval = 0
+            return 0
+        return self.backoff()
+
+    def error(self):
+        return self.backoff()
+
+    def backoff(self):
+        if self.interval == 0:
+            self.interval = self.initial_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.factor)
+        return self.interval * (1 - self.jitter * random.random())
+
+
 class Agent:
-    def __init__(self, url, location, job):
+    def __init__(self, url, location, job, slots=1, work_dir=None, max_poll_interval=60, hold=0, upload=True,
+                 compress=False):
         self.url = url
         self.location = location
         self.job = job
-        self.poll_interval = 10
-        log.info("Starting agent polling %s at interval %ds" % (self.url, self.poll_interval))
+        self.hold = hold
+        self.upload = upload
+        self.compress = compress
+        self.http = HttpClient(url, max_connections=slots + 1)
+        self.scheduler = PollScheduler(max_interval=max_poll_interval, long_poll=hold > 0)
+        self.stats = {'polls': 0, 'jobs': 0, 'empty_polls': 0, 'poll_errors': 0, 'poll_time': 0.0, 'idle_time': 0.0}
+        self.stopping = threading.Event()
+        self.jobs = []
+
+        # Every slot runs one test at a time, in its own directory and with its own lock file
+        if slots > 1 and work_dir is None:
+            work_dir = tempfile.mkdtemp(prefix='wpt_agent_')
+        self.slots = []
+        for i in range(slots):
+            if work_dir is None:
+                self.slots.append(Slot(i, None, None))
+            else:
+                directory = os.path.join(work_dir, "slot-%d" % i)
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                self.slots.append(Slot(i, directory, os.path.join(work_dir, "slot-%d.lock" % i)))
+        self.free_slots = Queue()
+        for slot in self.slots:
+            self.free_slots.put(slot)
+
+        log.info("Starting agent polling %s with %d slots" % (self.url, slots))
 
     def start(self):
-        while True:
-            log.info("Polling for job")
+        try:
+            while not self.stopping.is_set():
+                # Back-pressure, only poll when there is a slot free to run the job in
+                slot = self.acquire_slot()
+                if slot is None:
+                    break
+
+                start = time()
+                res = self.poll()
+                self.stats['polls'] += 1
+                self.stats['poll_time'] += time() - start
+
+                if res is not None and res.strip() != "":
+                    self.stats['jobs'] += 1
+                    self.start_job(slot, res)
+                    delay = self.scheduler.job_found()
+                else:
+                    self.free_slots.put(slot)
+                    if res is None:
+                        self.stats['poll_errors'] += 1
+                        delay = self.scheduler.error()
+                    else:
+                        log.info("No job found")
+                        self.stats['empty_polls'] += 1
+                        delay = self.scheduler.empty()
+
+                if delay > 0:
+                    log.debug("Polling again in %.1fs" % delay)
+                    start = time()
+                    self.stopping.wait(delay)
+                    self.stats['idle_time'] += time() - start
+        except KeyboardInterrupt:
+            log.info("Interrupted, waiting for running jobs to complete")
+            self.stop()
+        finally:
+            self.drain()
+            self.http.close()
+            log.info("Agent stopped after %(polls)d polls (%(jobs)d jobs, %(empty_polls)d empty, %(poll_errors)d "
+                     "errors), %(poll_time).1fs polling and %(idle_time).1fs idle" % self.stats)
+
+    def stop(self):
+        self.stopping.set()
+
+    def drain(self):
+        for t in self.jobs:
+            t.join()
+        self.jobs = []
+
+    def acquire_slot(self):
+        while not self.stopping.is_set():
             try:
-                query_string = urlencode({"location": self.location})
-                url = "{}/{}?{}".format(self.url, "work/getwork.php", query_string)
-                res = urlopen(url).read()
-            except URLError:
-                log.error("Error trying to poll for job, trying again later", exc_info=sys.exc_info())
-                sleep(self.poll_interval)
-                continue
-
-            if res.strip() != "":
-                self.spawn_job(res)
-            else:
-                log.info("No job found")
-            sleep(self.poll_interval)
+                return self.free_slots.get(timeout=1)
+            except Empty:
+                log.debug("All %d slots are busy" % len(self.slots))
+        return None
+
+    def poll(self):
+        log.info("Polling for job")
+        try:
+            params = {"location": self.location}
+            if self.hold > 0:
+                # Long-poll, the server holds the request until a job is available or the hold time has passed
+                params["hold"] = self.hold
+            return self.http.get("work/getwork.php", params, timeout=self.hold + POLL_TIMEOUT)
+        except (IOError, socket.error):
+            log.error("Error trying to poll for job, trying again later", exc_info=sys.exc_info())
+            return None
+
+    def start_job(self, slot, job_description):
+        if len(self.slots) == 1:
+            self.run_job(slot, job_description)
+        else:
+            t = threading.Thread(target=self.run_job, args=(slot, job_description), name="slot-%d" % slot.index)
+            self.jobs = [j for j in self.jobs if j.is_alive()] + [t]
+            t.start()
+
+    def run_job(self, slot, job_description):
+        try:
+            self.spawn_job(job_description, slot)
+        except Exception:
+            log.error("Error running job in slot %d" % slot.index, exc_info=sys.exc_info())
+        finally:
+            self.free_slots.put(slot)
+
+    def spawn_job(self, job_description, slot=None):
+        if slot is None:
+            slot = self.slots[0]
 
-    def spawn_job(self, job_description):
         config = ConfigParser.ConfigParser()
         config.readfp(io.BytesIO("[Job]\n%s" % job_description))
 
         test_id = config.get("Job", "Test ID")
-        log.info("Initiating job %s" % test_id)
+        log.info("Initiating job %s in slot %d" % (test_id, slot.index))
 
-        temp_directory = tempfile.mkdtemp(prefix='tmp_wpt_')
+        temp_directory = tempfile.mkdtemp(prefix='tmp_wpt_', dir=slot.directory)
         log.debug("Using %s as result directory", temp_directory)
         try:
             result_dir = ResultDirectory(temp_directory)
             with result_dir.open_file("test.job") as job_file:
                 job_file.write(job_description)
 
-            self.job(test_id, result_dir)
+            error = None
+            try:
+                self.job(test_id, result_dir, slot)
+            except Exception as e:
+                error = str(e) or e.__class__.__name__
+                raise
+            finally:
+                if self.upload:
+                    self.upload_results(test_id, result_dir, error)
 
         finally:
-            shutil.rmtree(temp_directory)
\ No newline at end of file
+            shutil.rmtree(temp_directory)
+
+    def upload_results(self, test_id, result_dir, error=None):
+        fields = [("id", test_id), ("location", self.location), ("done", "1")]
+        if error is not None:
+            fields.append(("error", error))
+
+        files = []
+        for root, dirs, names in os.walk(result_dir.folder):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                relative_path = os.path.relpath(path, result_dir.folder).replace(os.sep, "/")
+                if relative_path != "test.job":
+                    files.append(("file", relative_path, path))
+
+        log.info("Uploading %d result files of job %s" % (len(files), test_id))
+        start = time()
+        try:
+            self.http.upload("work/workdone.php", fields, files, compress=self.compress, timeout=UPLOAD_TIMEOUT)
+            log.info("Uploaded results of job %s in %.1fs" % (test_id, time() - start))
+        except (IOError, socket.error):
+            log.error("Error uploading results of job %s" % test_id, exc_info=sys.exc_info())
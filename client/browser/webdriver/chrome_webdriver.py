@@ -1,5 +1,7 @@
+import imp
 import json
 import logging
+import multiprocessing
 import os
 import sys
 from string import join
@@ -9,7 +11,6 @@ from selenium import webdriver
 
 from client.browser.webdriver.webdriver import WebDriver
 from client.capability import TraceCapability
-from client.process import run
 from client.provider import Provider, PostProcessingProvider
 from argparse import ArgumentParser, SUPPRESS
 
@@ -22,6 +23,9 @@ DEFAULT_TRACE_CATEGORIES = [
 
 logger = logging.getLogger(__name__)
 
+trace_parser = imp.load_source("trace_parser", os.path.join(os.path.dirname(__file__), "..", "..", "..",
+                                                              "lib", "trace", "trace-parser.py"))
+
 
 class ChromeWebDriver(WebDriver):
     def __init__(self, event_bus, config):
@@ -69,23 +73,65 @@ class ChromeWebDriver(WebDriver):
 class ChromeTraceParser(PostProcessingProvider):
     def __init__(self, event_bus, config):
         Provider.__init__(self, event_bus, config, lock_on="run")
+        self.pool = None
+        self.pending = []
+
+    @classmethod
+    def argparser(cls):
+        p = ArgumentParser(description=cls.__name__, prog=cls.__name__, add_help=False, parents=[Provider.argparser()])
+        p.add_argument('--trace-workers', dest='trace_workers', type=int, default=multiprocessing.cpu_count(),
+                       help="Number of trace files parsed in parallel (defaults to the number of cores)")
+        return p
+
+    def on_start_session(self, event):
+        super(ChromeTraceParser, self).on_start_session(event)
+        self.pool = multiprocessing.Pool(self.config.get('trace_workers') or multiprocessing.cpu_count())
+        self.pending = []
 
     def on_stop_run(self, event):
         trace_capability = TraceCapability(self.session)
 
-        i = 1
-        trace_files = trace_capability.get_trace_files()
+        # Traces are parsed in the background, the next run starts while the pool is working on them
+        trace_files = [f for f in trace_capability.get_trace_files() if f.run is self.run]
+        logger.info("Parsing %d chrome trace files of run %d" % (len(trace_files), self.run.current))
         for f in trace_files:
-            logger.info("Parsing chrome trace files %d of %d" % (i, len(trace_files)))
-
-            run([
-                sys.executable,
-                "lib/trace/trace-parser.py",
-                "-t", os.path.join(self.session.result_dir.folder, f.file),
-                "-u", os.path.join(self.session.result_dir.folder, trace_capability.get_user_timing_file(f)),
-                "-c", os.path.join(self.session.result_dir.folder, trace_capability.get_timeline_cpu_file(f)),
-                "-f", os.path.join(self.session.result_dir.folder, trace_capability.get_feature_usage_file(f))
-            ])
-            i += 1
+            folder = self.session.result_dir.folder
+            args = (f.file,
+                    os.path.join(folder, f.file),
+                    os.path.join(folder, trace_capability.get_user_timing_file(f)),
+                    os.path.join(folder, trace_capability.get_timeline_cpu_file(f)),
+                    os.path.join(folder, trace_capability.get_feature_usage_file(f)))
+            self.pending.append(self.pool.apply_async(_parse_trace, (args,)))
 
         super(ChromeTraceParser, self).on_stop_run(event)
+
+    def on_stop_session(self, event):
+        try:
+            failures = [f for f in [r.get() for r in self.pending] if f is not None]
+            self.pool.close()
+            self.pool.join()
+        finally:
+            self.pool.terminate()
+            self.pool = None
+            self.pending = []
+
+        super(ChromeTraceParser, self).on_stop_session(event)
+
+        if len(failures) > 0:
+            raise RuntimeError("Trace parsing failed for %s" % ", ".join(failures))
+
+    def on_abort(self, event):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+            self.pending = []
+        super(ChromeTraceParser, self).on_abort(event)
+
+
+def _parse_trace((name, trace_file, user_timing_file, cpu_file, features_file)):
+    try:
+        elapsed = trace_parser.ParseTrace(trace_file, user_timing_file, cpu_file, features_file)
+        logger.info("Parsed chrome trace file %s in %.1fs" % (name, elapsed))
+    except Exception:
+        logger.error("Error parsing chrome trace file %s" % name, exc_info=sys.exc_info())
+        return name
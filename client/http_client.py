@@ -0,0 +1,149 @@
+import httplib
+import logging
+import os
+import socket
+import threading
+import uuid
+import zlib
+from urllib import urlencode
+from urlparse import urlsplit
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_TIMEOUT = 30
+
+# Files that do not get any smaller by compressing them again
+COMPRESSED_EXTENSIONS = [".gz", ".zip", ".png", ".jpg", ".jpeg", ".mp4", ".webm"]
+
+logger = logging.getLogger(__name__)
+
+
+class HttpError(IOError):
+    def __init__(self, status, reason):
+        IOError.__init__(self, "HTTP %d %s" % (status, reason))
+        self.status = status
+        self.reason = reason
+
+
+class HttpClient:
+    """HTTP client for a single server that keeps up to max_connections connections alive between requests"""
+
+    def __init__(self, url, max_connections=4, timeout=DEFAULT_TIMEOUT):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path.rstrip("/")
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+
+    def get(self, path, params=None, timeout=None):
+        url = self._url(path) + ("?" + urlencode(params) if params else "")
+        return self._request(lambda c: c.request("GET", url), timeout)
+
+    def upload(self, path, fields, files, compress=False, timeout=None):
+        """POST fields and files as multipart/form-data. The body is streamed with chunked transfer encoding, the
+        files are read CHUNK_SIZE bytes at a time and optionally gzip compressed on the way"""
+        boundary = uuid.uuid4().hex
+
+        def send(c):
+            c.putrequest("POST", self._url(path), skip_accept_encoding=True)
+            c.putheader("Content-Type", "multipart/form-data; boundary=%s" % boundary)
+            c.putheader("Transfer-Encoding", "chunked")
+            c.endheaders()
+            for data in multipart(boundary, fields, files, compress):
+                if data:
+                    c.send("%x\r\n%s\r\n" % (len(data), data))
+            c.send("0\r\n\r\n")
+
+        return self._request(send, timeout)
+
+    def close(self):
+        with self.lock:
+            for c in self.idle:
+                c.close()
+            self.idle = []
+
+    def _url(self, path):
+        return "%s/%s" % (self.path, path.lstrip("/"))
+
+    def _request(self, send, timeout):
+        # A kept alive connection may have been closed by the server in the meantime, so a request failing on a
+        # reused connection is retried once on a new one
+        c, reused = self._acquire(timeout)
+        try:
+            try:
+                send(c)
+                response = c.getresponse()
+            except (httplib.HTTPException, socket.error):
+                c.close()
+                if not reused:
+                    raise
+                logger.debug("Kept alive connection to %s failed, reconnecting" % self.netloc)
+                c, reused = self._connect(timeout), False
+                send(c)
+                response = c.getresponse()
+            body = response.read()
+        except:
+            c.close()
+            raise
+
+        if response.will_close:
+            c.close()
+        else:
+            self._release(c)
+
+        if response.status < 200 or response.status >= 300:
+            raise HttpError(response.status, response.reason)
+        return body
+
+    def _acquire(self, timeout):
+        with self.lock:
+            if len(self.idle) > 0:
+                c = self.idle.pop()
+                c.sock.settimeout(timeout or self.timeout)
+                return c, True
+        return self._connect(timeout), False
+
+    def _release(self, c):
+        with self.lock:
+            if len(self.idle) < self.max_connections:
+                self.idle.append(c)
+                return
+        c.close()
+
+    def _connect(self, timeout):
+        with self.lock:
+            self.connections_opened += 1
+        if self.scheme == "https":
+            c = httplib.HTTPSConnection(self.netloc, timeout=timeout or self.timeout)
+        else:
+            c = httplib.HTTPConnection(self.netloc, timeout=timeout or self.timeout)
+        c.connect()
+        return c
+
+
+def multipart(boundary, fields, files, compress=False):
+    for name, value in fields:
+        yield "--%s\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n%s\r\n" % (boundary, name, value)
+
+    for name, file_name, path in files:
+        gzip = compress and os.path.splitext(file_name)[1].lower() not in COMPRESSED_EXTENSIONS
+        if gzip:
+            file_name += ".gz"
+        yield ("--%s\r\nContent-Disposition: form-data; name=\"%s\"; filename=\"%s\"\r\n"
+               "Content-Type: application/octet-stream\r\n\r\n" % (boundary, name, file_name))
+
+        with open(path, "rb") as f:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if gzip else None
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                yield compressor.compress(data) if compressor else data
+            if compressor:
+                yield compressor.flush()
+        yield "\r\n"
+
+    yield "--%s--\r\n" % boundary
@@ -1,8 +1,14 @@
 import logging
+import multiprocessing
 import os
 import re
+import resource
 import shutil
 import sys
+import threading
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+from time import time
 
 from client.provider import Provider, PostProcessingProvider
 from client.capability import VideoCapability
@@ -14,27 +20,51 @@ logger = logging.getLogger(__name__)
 class VisualMetrics(PostProcessingProvider):
     def __init__(self, event_bus, config):
         Provider.__init__(self, event_bus, config)
+        self.result_lock = threading.Lock()
+
+    @classmethod
+    def argparser(cls):
+        p = ArgumentParser(description=cls.__name__, prog=cls.__name__, add_help=False, parents=[Provider.argparser()])
+        p.add_argument('--concurrency', dest='concurrency', type=int, default=multiprocessing.cpu_count(),
+                       help="Number of videos processed in parallel (defaults to the number of cores)")
+        return p
 
     def on_stop_session(self, event):
         video_capability = VideoCapability(self.session)
 
-        self.lock()
-        try:
-            if len(video_capability.get_tmp_video_files()) > 0:
-                self.split_tmp_videos(video_capability)
+        start_time = time()
+        start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        pool = ThreadPool(self.config.get('concurrency') or multiprocessing.cpu_count())
 
-            self.process_videos(video_capability)
+        try:
+            # Only splitting tmp videos and naming the result files changes the session, the videos are processed
+            # without holding the lock
+            self.lock()
+            try:
+                failures = []
+                if len(video_capability.get_tmp_video_files()) > 0:
+                    failures.extend(self.split_tmp_videos(video_capability, pool))
+                commands = self.get_video_commands(video_capability)
+            finally:
+                self.unlock()
+
+            failures.extend(self.process_videos(commands, pool))
         finally:
-            self.unlock()
+            pool.terminate()
+
+        end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+        logger.info("Video processing took %.1fs wall clock time, %.1fs CPU time" % (time() - start_time, cpu_time))
+
         super(VisualMetrics, self).on_stop_session(event)
 
-    def process_videos(self, video_capability):
-        i = 1
-        video_files = video_capability.get_video_files()
-        for f in video_files:
-            logger.info("Running visualmetrics.py script for video output %d of %d" % (i, len(video_files)))
+        if len(failures) > 0:
+            raise RuntimeError("Video processing failed for %s" % ", ".join(failures))
 
-            process.run([
+    def get_video_commands(self, video_capability):
+        commands = []
+        for f in video_capability.get_video_files():
+            commands.append((f.file, [
                 sys.executable,
                 "lib/video/visualmetrics.py",
                 "-i", os.path.join(self.session.result_dir.folder, f.file),
@@ -42,120 +72,139 @@ class VisualMetrics(PostProcessingProvider):
                 "--histogram", os.path.join(self.session.result_dir.folder, video_capability.get_histograms_file(f)),
                 "-d", os.path.join(self.session.result_dir.folder, video_capability.get_video_directory(f)),
                 "--forceblank",
+                "--stream",
                 "-o",
                 "-f",
                 "-p"
-            ])
-            i += 1
+            ]))
+        return commands
+
+    def process_videos(self, commands, pool):
+        logger.info("Running visualmetrics.py script for %d videos" % len(commands))
+        return [f for f in pool.map(self._process_video, commands) if f is not None]
 
-    def split_tmp_videos(self, video_capability):
+    def _process_video(self, (name, cmd)):
+        start_time = time()
+        try:
+            process.run(cmd)
+            logger.info("Processed video %s in %.1fs" % (name, time() - start_time))
+        except Exception:
+            logger.error("Error processing video %s" % name, exc_info=sys.exc_info())
+            return name
+
+    def split_tmp_videos(self, video_capability, pool):
+        video_files = video_capability.get_tmp_video_files()
+        logger.info("Running visualmetrics.py to split %d tmp videos" % len(video_files))
+        return [f for f in pool.map(self._split_tmp_video, enumerate(video_files)) if f is not None]
+
+    def _split_tmp_video(self, (i, tmp_video_file)):
+        try:
+            self.split_tmp_video(video_capability=VideoCapability(self.session), tmp_video_file=tmp_video_file,
+                                 video_dir=os.path.join(self.session.result_dir.folder, "tmp_video_split_%d" % i))
+        except Exception:
+            logger.error("Error splitting tmp video %s" % tmp_video_file.file, exc_info=sys.exc_info())
+            return tmp_video_file.file
+
+    def split_tmp_video(self, video_capability, tmp_video_file, video_dir):
         def get_images(d): return [os.path.join(d, i) for i in os.listdir(d) if i.endswith(".png")]
 
         def get_folders(d): return [os.path.join(d, p) for p in os.listdir(d)
                                     if os.path.isdir(os.path.join(d, p)) and not p.startswith(".")]
 
-        i = 1
-        video_files = video_capability.get_tmp_video_files()
-        for tmp_video_file in video_files:
-            logger.info("Running visualmetrics.py to split tmp video %d of %d" % (i, len(video_files)))
-
-            # Split video
-            process.run([sys.executable,
-                 "lib/video/visualmetrics.py",
-                 "--multiple",
-                 "-l",
-                 "-q", "100",
-                 "-i", os.path.join(self.session.result_dir.folder, tmp_video_file.file),
-                 "-d", os.path.join(self.session.result_dir.folder, "video"),
-                 "-o"], ignore_return_code=True)
-
-            # Rebuild videos
-            video_dir = os.path.join(self.session.result_dir.folder, "video")
-            for f in get_folders(video_dir):
-                images = get_images(f)
-                if len(images) == 0:
-                    break
-
-                logger.info("Joining video %s" % (os.path.basename(f)))
-
-                images.sort()
-                images.reverse()
-
-                fps, duration = 60, 100
-                p = process.launch(['ffmpeg',
-                           '-y',
-                           '-f', 'image2pipe',
-                           '-r', str(fps),
-                           '-vcodec', 'png',
-                           '-i', '-',
-                           '-an',
-                           '-vcodec', 'libx264',
-                           '-preset', 'ultrafast',
-                           '-tune', 'zerolatency',
-                           '-pix_fmt', 'yuv420p',
-                           os.path.join(f, "video.mp4")], pipe_stdin=True)[0]
-
-                current_file = images.pop()
-                ts = 0
-                while len(images) > 0:
-                    ts_of_current_file = int(re.sub(".*/ms_([0-9]+)\\.png", "\\1", current_file))
-                    if ts > ts_of_current_file:
-                        current_file = images.pop()
-                    with open(current_file, "rb") as file:
-                        p.stdin.write(file.read())
-                    ts += (1000 / fps)
-                p.stdin.close()
-                p.wait()
-
-                # Clean video directory
-                logger.debug("Cleaning directory %s for png-images" % f)
-                for png_file in get_images(f):
-                    os.remove(png_file)
-
-                # Move merged video file to correct file name
-                if tmp_video_file.view is not None:
-                    # One file per view
-                    run = tmp_video_file.run.current - 1
-                    view = 0 if tmp_video_file.view.is_first else 1
-                    step = int(os.path.basename(f)) - 1
-
-                    logger.debug("Video %s is run=%d, view=%d, step=%d" % (os.path.basename(f), run, view, step))
-                    os.rename(os.path.join(f, "video.mp4"),
-                              video_capability.get_video_file(tmp_video_file.run, tmp_video_file.view,
-                                                              self.session.runs[run].views[view].steps[step]))
-                elif tmp_video_file.run is not None:
-                    # One file per run
-                    run = tmp_video_file.run.current - 1
-                    step = int(os.path.basename(f)) - 1
-                    view = 0
-                    if step > len(self.session.runs[run].views[0].steps):
-                        view = 1
-                        step -= len(self.session.runs[run].views[0].steps)
-
-                    logger.debug("Video %s is run=%d, view=%d, step=%d" % (os.path.basename(f), run, view, step))
-                    os.rename(os.path.join(f, "video.mp4"),
-                              video_capability.get_video_file(tmp_video_file.run,
-                                                              self.session.runs[run].views[view],
-                                                              self.session.runs[run].views[view].steps[step]))
-                else:
-                    # One file per session
-                    steps_per_view = len(self.session.runs[0].views[0].steps)
-                    views_per_run = len(self.session.runs[0].views)
-
-                    num = int(os.path.basename(f)) - 1
-
-                    run = num / (steps_per_view * views_per_run)
-                    view = (num - (run * views_per_run * steps_per_view)) / steps_per_view
-                    step = num - (run * views_per_run * steps_per_view) - (view * steps_per_view)
-
-                    logger.debug("Video %s is run=%d, view=%d, step=%d" % (os.path.basename(f), run, view, step))
-                    os.rename(os.path.join(f, "video.mp4"),
-                              video_capability.get_video_file(self.session.runs[run],
-                                                              self.session.runs[run].views[view],
-                                                              self.session.runs[run].views[view].steps[step]))
-
-            i += 1
-
-            shutil.rmtree(video_dir)
-
-        os.remove(os.path.join(self.session.result_dir.folder, tmp_video_file.file))
\ No newline at end of file
+        # Split video
+        process.run([sys.executable,
+                     "lib/video/visualmetrics.py",
+                     "--multiple",
+                     "-l",
+                     "-q", "100",
+                     "-i", os.path.join(self.session.result_dir.folder, tmp_video_file.file),
+                     "-d", video_dir,
+                     "-o"], ignore_return_code=True)
+
+        # Rebuild videos
+        for f in get_folders(video_dir):
+            images = get_images(f)
+            if len(images) == 0:
+                break
+
+            logger.info("Joining video %s" % (os.path.basename(f)))
+
+            images.sort()
+            images.reverse()
+
+            fps, duration = 60, 100
+            p = process.launch(['ffmpeg',
+                                '-y',
+                                '-f', 'image2pipe',
+                                '-r', str(fps),
+                                '-vcodec', 'png',
+                                '-i', '-',
+                                '-an',
+                                '-vcodec', 'libx264',
+                                '-preset', 'ultrafast',
+                                '-tune', 'zerolatency',
+                                '-pix_fmt', 'yuv420p',
+                                os.path.join(f, "video.mp4")], pipe_stdin=True)[0]
+
+            current_file = images.pop()
+            ts = 0
+            while len(images) > 0:
+                ts_of_current_file = int(re.sub(".*/ms_([0-9]+)\\.png", "\\1", current_file))
+                if ts > ts_of_current_file:
+                    current_file = images.pop()
+                with open(current_file, "rb") as file:
+                    p.stdin.write(file.read())
+                ts += (1000 / fps)
+            p.stdin.close()
+            p.wait()
+
+            # Clean video directory
+            logger.debug("Cleaning directory %s for png-images" % f)
+            for png_file in get_images(f):
+                os.remove(png_file)
+
+            # Move merged video file to correct file name
+            if tmp_video_file.view is not None:
+                # One file per view
+                run = tmp_video_file.run.current - 1
+                view = 0 if tmp_video_file.view.is_first else 1
+                step = int(os.path.basename(f)) - 1
+
+                logger.debug("Video %s is run=%d, view=%d, step=%d" % (os.path.basename(f), run, view, step))
+                with self.result_lock:
+                    video_file = video_capability.get_video_file(tmp_video_file.run, tmp_video_file.view,
+                                                                 self.session.runs[run].views[view].steps[step])
+            elif tmp_video_file.run is not None:
+                # One file per run
+                run = tmp_video_file.run.current - 1
+                step = int(os.path.basename(f)) - 1
+                view = 0
+                if step > len(self.session.runs[run].views[0].steps):
+                    view = 1
+                    step -= len(self.session.runs[run].views[0].steps)
+
+                logger.debug("Video %s is run=%d, view=%d, step=%d" % (os.path.basename(f), run, view, step))
+                with self.result_lock:
+                    video_file = video_capability.get_video_file(tmp_video_file.run,
+                                                                 self.session.runs[run].views[view],
+                                                                 self.session.runs[run].views[view].steps[step])
+            else:
+                # One file per session
+                steps_per_view = len(self.session.runs[0].views[0].steps)
+                views_per_run = len(self.session.runs[0].views)
+
+                num = int(os.path.basename(f)) - 1
+
+                run = num / (steps_per_view * views_per_run)
+                view = (num - (run * views_per_run * steps_per_view)) / steps_per_view
+                step = num - (run * views_per_run * steps_per_view) - (view * steps_per_view)
+
+                logger.debug("Video %s is run=%d, view=%d, step=%d" % (os.path.basename(f), run, view, step))
+                with self.result_lock:
+                    video_file = video_capability.get_video_file(self.session.runs[run],
+                                                                 self.session.runs[run].views[view],
+                                                                 self.session.runs[run].views[view].steps[step])
+            os.rename(os.path.join(f, "video.mp4"), video_file)
+
+        shutil.rmtree(video_dir)
+        os.remove(os.path.join(self.session.result_dir.folder, tmp_video_file.file))
@@ -19,8 +19,12 @@ import json
 import logging
 import math
 import os
+import re
 import time
 
+TRACE_CHUNK_SIZE = 1024 * 1024
+TRACE_MAX_EVENT_SIZE = 16 * 1024 * 1024
+
 ########################################################################################################################
 #   Trace processing
 ########################################################################################################################
@@ -42,7 +46,6 @@ class Trace():
 
   def Process(self, trace):
     f = None
-    line_mode = False
     self.__init__()
     try:
       file_name, ext = os.path.splitext(trace)
@@ -50,15 +53,9 @@ class Trace():
         f = gzip.open(trace, 'rb')
       else:
         f = open(trace, 'r')
-      for line in f:
+      for trace_event in TraceReader(f).Events():
         try:
-          trace_event = json.loads(line.strip("\r\n\t ,"))
-          if not line_mode and 'traceEvents' in trace_event:
-            for sub_event in trace_event['traceEvents']:
-              self.ProcessEvent(sub_event)
-          else:
-            line_mode = True
-            self.ProcessEvent(trace_event)
+          self.ProcessEvent(trace_event)
         except:
           pass
     except:
@@ -191,16 +188,119 @@ class Trace():
         for name in self.threads[thread].keys():
           self.cpu['slices'][thread][name] = [0.0] * slice_count
 
-      # Go through all of the timeline events recursively and account for the time they consumed
-      for timeline_event in self.timeline_events:
-        self.ProcessTimelineEvent(timeline_event, None)
+      # Go through all of the timeline events and account for the time they consumed
+      try:
+        self.ProcessTimelineSlices(slice_count)
+      except ImportError:
+        self.ProcessTimelineSlicesPython()
+
+  def ProcessTimelineSlicesPython(self):
+    # Go through all of the timeline events recursively and account for the time they consumed
+    for timeline_event in self.timeline_events:
+      self.ProcessTimelineEvent(timeline_event, None)
+
+    # Go through all of the fractional times and convert the float fractional times to integer usecs
+    for thread in self.cpu['slices'].keys():
+      for name in self.cpu['slices'][thread].keys():
+        for slice in range(len(self.cpu['slices'][thread][name])):
+          self.cpu['slices'][thread][name][slice] =\
+            int(self.cpu['slices'][thread][name][slice] * self.cpu['slice_usecs'])
+
+  # Same accounting as ProcessTimelineEvent/AdjustTimelineSlice but on a dense (slices x names) array per thread.
+  # Slices don't affect each other so the n-th adjustment of every slice is applied in one batch, using the same
+  # floating point operations in the same order as the per-slice version. The resulting integer usecs are identical.
+  def ProcessTimelineSlices(self, slice_count):
+    import numpy
+
+    rows = {}
+    events = {}
+    for thread in self.cpu['slices'].keys():
+      rows[thread] = dict((name, row) for row, name in enumerate(self.cpu['slices'][thread].keys()))
+      events[thread] = []
+
+    # Flatten the events in the same (depth first) order as the recursive version
+    pending = [(timeline_event, None) for timeline_event in reversed(self.timeline_events)]
+    while len(pending):
+      timeline_event, parent = pending.pop()
+      start = timeline_event['s'] - self.start_time
+      end = timeline_event['e'] - self.start_time
+      if end > start:
+        thread = timeline_event['t']
+        name = self.event_name_lookup[timeline_event['n']]
+        events[thread].append((rows[thread][name], -1 if parent is None else rows[thread][parent], start, end))
+        if 'c' in timeline_event:
+          for child in reversed(timeline_event['c']):
+            pending.append((child, name))
+
+    for thread in self.cpu['slices'].keys():
+      slices = self.CalculateThreadSlices(events[thread], len(rows[thread]), slice_count)
+      usecs = (slices * self.cpu['slice_usecs']).astype(numpy.int64)
+      for name, row in rows[thread].iteritems():
+        self.cpu['slices'][thread][name] = usecs[:, row].tolist()
+
+  def CalculateThreadSlices(self, events, name_count, slice_count):
+    import numpy
+
+    slice_usecs = self.cpu['slice_usecs']
+    slices = numpy.zeros((slice_count, name_count))
+    if not len(events):
+      return slices
+    row, parent, start, end = numpy.array(events, dtype=numpy.int64).T
 
-      # Go through all of the fractional times and convert the float fractional times to integer usecs
-      for thread in self.cpu['slices'].keys():
-        for name in self.cpu['slices'][thread].keys():
-          for slice in range(len(self.cpu['slices'][thread][name])):
-            self.cpu['slices'][thread][name][slice] =\
-              int(self.cpu['slices'][thread][name][slice] * self.cpu['slice_usecs'])
+    # One adjustment for every slice an event covers (slices past the end are ignored, like the IndexError was)
+    first_slice = (start.astype(numpy.float64) / float(slice_usecs)).astype(numpy.int64)
+    last_slice = numpy.minimum((end.astype(numpy.float64) / float(slice_usecs)).astype(numpy.int64), slice_count - 1)
+    counts = numpy.maximum(0, last_slice - first_slice + 1)
+    event = numpy.repeat(numpy.arange(len(events)), counts)
+    column = first_slice[event] + numpy.arange(len(event)) - (numpy.cumsum(counts) - counts)[event]
+    slice_start = column * slice_usecs
+    elapsed = numpy.minimum(slice_start + slice_usecs, end[event]) - numpy.maximum(slice_start, start[event])
+    fraction = numpy.minimum(1.0, elapsed.astype(numpy.float64) / float(slice_usecs))
+
+    # Number the adjustments of each slice in event order and apply them a step at a time across all of the slices
+    order = numpy.argsort(column, kind='mergesort')
+    column, event, fraction = column[order], event[order], fraction[order]
+    step = numpy.arange(len(column)) - numpy.searchsorted(column, column)
+    order = numpy.argsort(step, kind='mergesort')
+    position = 0
+    for count in numpy.bincount(step):
+      batch = order[position:position + count]
+      position += count
+      self.AdjustTimelineSlices(slices, column[batch], row[event[batch]], parent[event[batch]], fraction[batch])
+    return slices
+
+  # Batched AdjustTimelineSlice for a set of distinct slices
+  def AdjustTimelineSlices(self, slices, columns, rows, parent_rows, fractions):
+    import numpy
+
+    slices[columns, rows] = numpy.minimum(1.0, slices[columns, rows] + fractions)
+    has_parent = parent_rows >= 0
+    if has_parent.any():
+      parent_columns = columns[has_parent]
+      parent_rows = parent_rows[has_parent]
+      slices[parent_columns, parent_rows] = numpy.maximum(0.0, slices[parent_columns, parent_rows] -
+                                                          fractions[has_parent])
+
+    # make sure we don't exceed 100% for any slot. The other names keep their time until the available time runs out,
+    # the one where it runs out gets what is left and the ones after it get nothing.
+    available = 1.0 - fractions
+    values = slices[columns]
+    others = values.copy()
+    others[numpy.arange(len(columns)), rows] = 0.0
+    full = others.sum(axis=1) >= available - 1e-9
+    if not full.any():
+      return
+    columns, rows, available, values, others = columns[full], rows[full], available[full], values[full], others[full]
+    remaining = numpy.subtract.accumulate(numpy.column_stack((available, others)), axis=1)[:, :-1]
+    over = others > remaining
+    capped = over.any(axis=1)
+    if capped.any():
+      first_over = over.argmax(axis=1)[:, None]
+      index = numpy.arange(values.shape[1])[None, :]
+      capped_values = numpy.where(index < first_over, values, numpy.where(index == first_over, remaining, 0.0))
+      own = numpy.arange(len(columns))
+      capped_values[own, rows] = values[own, rows]
+      slices[columns[capped]] = capped_values[capped]
 
   def ProcessTimelineEvent(self, timeline_event, parent):
     start = timeline_event['s'] - self.start_time
@@ -275,9 +375,145 @@ class Trace():
           self.feature_usage['CSSFeatures'][name] = timestamp
 
 
+########################################################################################################################
+#   Incremental trace reader
+########################################################################################################################
+class TraceReader():
+  # Yields the events of a trace one at a time without loading the whole file. Handles a JSON array of events, one
+  # event per line (with or without trailing commas) and an object with a "traceEvents" array anywhere in it.
+  SEPARATORS = re.compile(r'[\s,]*')
+  WHITESPACE = re.compile(r'\s*')
+
+  def __init__(self, f, chunk_size=TRACE_CHUNK_SIZE, max_event_size=TRACE_MAX_EVENT_SIZE):
+    self.f = f
+    self.chunk_size = chunk_size
+    self.max_event_size = max_event_size
+    self.decoder = json.JSONDecoder()
+    self.buffer = ''
+    self.pos = 0
+    self.eof = False
+
+  def Events(self):
+    while self.Skip(self.SEPARATORS):
+      c = self.buffer[self.pos]
+      if c == '[':
+        self.pos += 1
+        for trace_event in self.ArrayEvents():
+          yield trace_event
+      elif c == '{':
+        for trace_event in self.ObjectEvents():
+          yield trace_event
+      else:
+        ok, trace_event = self.Decode()
+        if ok:
+          yield trace_event
+
+  def ArrayEvents(self):
+    while self.Skip(self.SEPARATORS):
+      if self.buffer[self.pos] == ']':
+        self.pos += 1
+        return
+      ok, trace_event = self.Decode()
+      if ok:
+        yield trace_event
+
+  def ObjectEvents(self):
+    # Top level objects are read a key at a time so a "traceEvents" array can be streamed wherever it is. Any other
+    # object is a single event.
+    trace_event = {}
+    has_trace_events = False
+    self.pos += 1
+    while self.Skip(self.SEPARATORS):
+      if self.buffer[self.pos] == '}':
+        self.pos += 1
+        break
+      ok, key = self.Decode()
+      if not ok or not self.Skip(self.WHITESPACE) or self.buffer[self.pos] != ':':
+        return
+      self.pos += 1
+      if not self.Skip(self.WHITESPACE):
+        return
+      if key == 'traceEvents' and self.buffer[self.pos] == '[':
+        self.pos += 1
+        has_trace_events = True
+        for sub_event in self.ArrayEvents():
+          yield sub_event
+      else:
+        ok, trace_event[key] = self.Decode()
+        if not ok:
+          return
+    if not has_trace_events:
+      yield trace_event
+
+  def Read(self):
+    data = self.f.read(self.chunk_size)
+    if data:
+      self.buffer = self.buffer[self.pos:] + data
+      self.pos = 0
+    else:
+      self.eof = True
+
+  def Skip(self, pattern):
+    while True:
+      self.pos = pattern.match(self.buffer, self.pos).end()
+      if self.pos < len(self.buffer):
+        return True
+      if self.eof:
+        return False
+      self.Read()
+
+  def SkipLine(self):
+    while True:
+      end = self.buffer.find('\n', self.pos)
+      if end >= 0:
+        self.pos = end + 1
+        return
+      self.pos = len(self.buffer)
+      if self.eof:
+        return
+      self.Read()
+
+  def Decode(self):
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, self.pos)
+        if end == len(self.buffer) and not self.eof:
+          # A number at the end of the buffer may continue in the next chunk
+          self.Read()
+          continue
+        self.pos = end
+        return True, value
+      except ValueError:
+        # Either the value is not complete in the buffer yet or it is corrupt, in which case skip the rest of the line
+        if not self.eof and len(self.buffer) - self.pos < self.max_event_size:
+          self.Read()
+          continue
+        logging.debug("Skipping invalid trace data")
+        self.SkipLine()
+        return False, None
+
+
 ########################################################################################################################
 #   Main Entry Point
 ########################################################################################################################
+def ParseTrace(trace_file, user_timing_file=None, cpu_file=None, features_file=None):
+  """Parse a trace and write the requested output files, returns the elapsed time in seconds"""
+  start = time.time()
+  trace = Trace()
+  trace.Process(trace_file)
+
+  if user_timing_file:
+    trace.WriteUserTiming(user_timing_file)
+
+  if cpu_file:
+    trace.WriteCPUSlices(cpu_file)
+
+  if features_file:
+    trace.WriteFeatureUsage(features_file)
+
+  return time.time() - start
+
+
 def main():
   import argparse
   parser = argparse.ArgumentParser(description='Chrome trace parser.',
@@ -305,21 +541,7 @@ def main():
   if not options.trace:
     parser.error("Input trace file is not specified.")
 
-  start = time.time()
-  trace = Trace()
-  trace.Process(options.trace)
-
-  if options.user:
-    trace.WriteUserTiming(options.user)
-
-  if options.cpu:
-    trace.WriteCPUSlices(options.cpu)
-
-  if options.features:
-    trace.WriteFeatureUsage(options.features)
-
-  end = time.time()
-  elapsed = end - start
+  elapsed = ParseTrace(options.trace, options.user, options.cpu, options.features)
   logging.debug("Elapsed Time: {0:0.4f}".format(elapsed))
 
 
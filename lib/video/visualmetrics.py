@@ -26,6 +26,8 @@ PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
 LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
 NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."""
+import collections
+import fnmatch
 import gc
 import glob
 import gzip
@@ -42,6 +44,183 @@ import tempfile
 # Globals
 options = None
 client_viewport = None
+frame_cache = None
+memory_frames = {}
+frame_histograms = {}
+
+
+########################################################################################################################
+# Decoded frame cache
+########################################################################################################################
+
+class FrameCache(object):
+  # Keeps decoded frames in memory (least recently used first out) so every processing stage working on the same
+  # PNG doesn't need to decode it again. Entries are keyed by path and validated against the file's mtime and size,
+  # so frames rewritten on disk (blanking, cropping) are decoded again.
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.frames = collections.OrderedDict()
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, file):
+    try:
+      stat = os.stat(file)
+    except OSError:
+      self.discard(file)
+      return None
+    key = (stat.st_mtime, stat.st_size)
+    entry = self.frames.pop(file, None)
+    if entry is not None and entry[0] == key:
+      self.hits += 1
+      self.frames[file] = entry
+      return entry[1]
+    if entry is not None:
+      self.bytes -= entry[2]
+
+    self.misses += 1
+    pixels = decode_image_array(file)
+    size = pixels.nbytes if pixels is not None else 0
+    if size <= self.max_bytes:
+      self.frames[file] = (key, pixels, size)
+      self.bytes += size
+      self.evict()
+    return pixels
+
+  def put(self, file, pixels):
+    self.discard(file)
+    stat = os.stat(file)
+    if pixels.nbytes <= self.max_bytes:
+      self.frames[file] = ((stat.st_mtime, stat.st_size), pixels, pixels.nbytes)
+      self.bytes += pixels.nbytes
+      self.evict()
+
+  def evict(self):
+    # Frames held in memory_frames count against the same budget
+    memory_bytes = memory_frame_bytes()
+    while len(self.frames) and self.bytes + memory_bytes > self.max_bytes:
+      evicted_file, evicted = self.frames.popitem(last=False)
+      self.bytes -= evicted[2]
+
+  def move(self, src, dest):
+    self.discard(dest)
+    entry = self.frames.pop(src, None)
+    if entry is not None:
+      self.frames[dest] = entry
+
+  def discard(self, file):
+    entry = self.frames.pop(file, None)
+    if entry is not None:
+      self.bytes -= entry[2]
+
+  def __repr__(self):
+    return 'FrameCache(frames={0:d}, bytes={1:d}, hits={2:d}, misses={3:d})'.format(len(self.frames), self.bytes,
+                                                                                      self.hits, self.misses)
+
+
+def get_memory_budget():
+  global options
+  if options is not None and options.cachesize > 0:
+    return options.cachesize * 1024 * 1024
+  return 256 * 1024 * 1024
+
+
+def memory_frame_bytes():
+  global memory_frames
+  return sum(pixels.nbytes for pixels in memory_frames.itervalues())
+
+
+def load_image_array(file):
+  global frame_cache
+  global memory_frames
+  if file in memory_frames:
+    return memory_frames[file]
+  if frame_cache is not None:
+    return frame_cache.get(file)
+  return decode_image_array(file)
+
+
+def get_frame_size(file):
+  pixels = load_image_array(file)
+  if pixels is not None:
+    height, width = pixels.shape[:2]
+    return width, height
+  from PIL import Image
+  with Image.open(file) as im:
+    return im.size
+
+
+# Frames extracted with --stream only exist in memory (in memory_frames, keyed by the path they will be written to)
+# until write_memory_frames is called. The helpers below work on both kinds of frames.
+def list_frames(directory, pattern):
+  global memory_frames
+  frames = set(glob.glob(os.path.join(directory, pattern)))
+  for file in memory_frames:
+    if os.path.dirname(file) == directory and fnmatch.fnmatch(os.path.basename(file), pattern):
+      frames.add(file)
+  return sorted(frames)
+
+
+def open_frame_image(file):
+  global memory_frames
+  from PIL import Image
+  if file in memory_frames:
+    return Image.fromarray(memory_frames[file])
+  return Image.open(file)
+
+
+def frame_exists(file):
+  global memory_frames
+  return file in memory_frames or os.path.isfile(file)
+
+
+def move_frame(src, dest):
+  global frame_cache
+  global memory_frames
+  if src in memory_frames:
+    memory_frames[dest] = memory_frames.pop(src)
+  else:
+    os.rename(src, dest)
+    if frame_cache is not None:
+      frame_cache.move(src, dest)
+
+
+def copy_frame(src, dest):
+  global memory_frames
+  if src in memory_frames:
+    memory_frames[dest] = memory_frames[src]
+  else:
+    shutil.copyfile(src, dest)
+
+
+def remove_frame(file):
+  global frame_cache
+  global memory_frames
+  if file in memory_frames:
+    del memory_frames[file]
+  else:
+    os.remove(file)
+    if frame_cache is not None:
+      frame_cache.discard(file)
+
+
+def write_memory_frames(directory=None):
+  global options
+  global frame_cache
+  global frame_histograms
+  global memory_frames
+  from PIL import Image
+  for file in sorted(memory_frames.keys()):
+    if directory is None or os.path.dirname(file) == directory:
+      pixels = memory_frames.pop(file)
+      Image.fromarray(pixels).save(file)
+      # Calculate the histogram while the frame is still decoded instead of loading the PNG again later
+      if options is not None and options.histogram:
+        stat = os.stat(file)
+        frame_histograms[file] = ((stat.st_mtime, stat.st_size), calculate_array_histogram(pixels))
+      if frame_cache is not None:
+        frame_cache.put(file, pixels)
 
 
 # #######################################################################################################################
@@ -52,6 +231,7 @@ def video_to_frames(video, directory, force, orange_file, multiple, find_viewpor
                     timeline_file, trim_end):
   global options
   global client_viewport
+  global memory_frames
   first_frame = os.path.join(directory, 'ms_000000')
   if (not os.path.isfile(first_frame + '.png') and not os.path.isfile(first_frame + '.jpg')) or force:
     if os.path.isfile(video):
@@ -65,19 +245,26 @@ def video_to_frames(video, directory, force, orange_file, multiple, find_viewpor
         directory = os.path.realpath(directory)
         viewport = find_video_viewport(video, directory, find_viewport, viewport_time)
         gc.collect()
-        if extract_frames(video, directory, full_resolution, viewport):
+        if stream_frames(options):
+          extracted = extract_frames_stream(video, directory, full_resolution, viewport)
+        else:
+          extracted = extract_frames(video, directory, full_resolution, viewport)
+        if extracted:
           client_viewport = None
           if find_viewport and options.notification:
             client_viewport = find_image_viewport(os.path.join(directory, 'video-000000.png'))
+          classified = {}
           if multiple and orange_file is not None:
-            directories = split_videos(directory, orange_file)
+            directories, classified = split_videos(directory, orange_file)
           else:
             directories = [directory]
           for dir in directories:
             trim_video_end(dir, trim_end)
             if orange_file is not None:
-              remove_frames_before_orange(dir, orange_file)
-              remove_orange_frames(dir, orange_file)
+              frames = list_frames(dir, 'video-*.png')
+              orange = find_orange_frames(frames, orange_file, classified)
+              frames, orange = remove_frames_before_orange(frames, orange)
+              remove_orange_frames(frames, orange)
             find_first_frame(dir)
             find_render_start(dir)
             adjust_frame_times(dir)
@@ -90,7 +277,10 @@ def video_to_frames(video, directory, force, orange_file, multiple, find_viewpor
             if options.maxframes > 0:
               cap_frame_count(dir, options.maxframes)
             crop_viewport(dir)
+            write_memory_frames(dir)
             gc.collect()
+          # Anything left in memory is outside of the split video directories
+          memory_frames.clear()
         else:
           logging.critical("Error extracting the video frames from " + video)
       else:
@@ -106,14 +296,8 @@ def extract_frames(video, directory, full_resolution, viewport):
   logging.info("Extracting frames from " + video + " to " + directory)
   decimate = get_decimate_filter()
   if decimate is not None:
-    crop = ''
-    if viewport is not None:
-      crop = 'crop={0}:{1}:{2}:{3},'.format(viewport['width'], viewport['height'], viewport['x'], viewport['y'])
-    scale = 'scale=iw*min(400/iw\,400/ih):ih*min(400/iw\,400/ih),'
-    if full_resolution:
-      scale = ''
     command = ['ffmpeg', '-v', 'debug', '-i', video, '-vsync', '0',
-               '-vf', crop + scale + decimate + '=0:64:640:0.001',
+               '-vf', get_extract_filter(decimate, full_resolution, viewport),
                os.path.join(directory, 'img-%d.png')]
     logging.debug(' '.join(command))
     lines = []
@@ -121,38 +305,147 @@ def extract_frames(video, directory, full_resolution, viewport):
     while p.poll() is None:
       lines.extend(iter(p.stderr.readline, ""))
 
-    match = re.compile('keep pts:[0-9]+ pts_time:(?P<timecode>[0-9\.]+)')
     frame_count = 0
-    for line in lines:
-      m = re.search(match, line)
-      if m:
-        frame_count += 1
-        frame_time = int(math.ceil(float(m.groupdict().get('timecode')) * 1000))
-        src = os.path.join(directory, 'img-{0:d}.png'.format(frame_count))
-        dest = os.path.join(directory, 'video-{0:06d}.png'.format(frame_time))
-        logging.debug('Renaming ' + src + ' to ' + dest)
-        os.rename(src, dest)
-        ok = True
+    for frame_time in get_frame_times(lines):
+      frame_count += 1
+      src = os.path.join(directory, 'img-{0:d}.png'.format(frame_count))
+      dest = os.path.join(directory, 'video-{0:06d}.png'.format(frame_time))
+      logging.debug('Renaming ' + src + ' to ' + dest)
+      os.rename(src, dest)
+      ok = True
 
   return ok
 
 
+def extract_frames_stream(video, directory, full_resolution, viewport):
+  # Same as extract_frames but ffmpeg writes raw rgb24 frames to stdout. The frames are kept in memory_frames and
+  # only the ones surviving the processing stages are written to disk by write_memory_frames. Once the memory budget
+  # is used up the remaining frames are written out as PNGs like extract_frames does.
+  global memory_frames
+  import numpy
+  from PIL import Image
+  import threading
+
+  ok = False
+  logging.info("Streaming frames from " + video + " for " + directory)
+  decimate = get_decimate_filter()
+  if decimate is not None:
+    command = ['ffmpeg', '-v', 'debug', '-i', video, '-vsync', '0',
+               '-vf', get_extract_filter(decimate, full_resolution, viewport),
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']
+    logging.debug(' '.join(command))
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # stderr has to be drained while the frames are read. The frame size is only known once ffmpeg logs the
+    # output stream.
+    lines = []
+    size = {}
+    size_found = threading.Event()
+    size_match = re.compile('Video: rawvideo.* (?P<width>[0-9]+)x(?P<height>[0-9]+)')
+
+    def read_log():
+      output = False
+      for line in iter(p.stderr.readline, ""):
+        lines.append(line)
+        if line.startswith('Output #0'):
+          output = True
+        elif output and not size_found.is_set():
+          m = re.search(size_match, line)
+          if m is not None:
+            size['width'] = int(m.group('width'))
+            size['height'] = int(m.group('height'))
+            size_found.set()
+      size_found.set()
+
+    log_reader = threading.Thread(target=read_log)
+    log_reader.daemon = True
+    log_reader.start()
+    size_found.wait()
+
+    frames = []
+    if size:
+      shape = (size['height'], size['width'], 3)
+      frame_bytes = shape[0] * shape[1] * 3
+      available = get_memory_budget() - memory_frame_bytes()
+      while True:
+        data = p.stdout.read(frame_bytes)
+        if len(data) < frame_bytes:
+          break
+        pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape(shape)
+        if available >= frame_bytes:
+          available -= frame_bytes
+          frames.append(pixels)
+        else:
+          spilled = os.path.join(directory, 'img-{0:d}.png'.format(len(frames) + 1))
+          Image.fromarray(pixels).save(spilled)
+          frames.append(spilled)
+    else:
+      p.stdout.read()
+    p.wait()
+    log_reader.join()
+
+    frame_times = get_frame_times(lines)
+    if len(frame_times) != len(frames):
+      logging.warning('ffmpeg reported {0:d} frames but {1:d} were read'.format(len(frame_times), len(frames)))
+    spilled_count = 0
+    for frame_time, frame in zip(frame_times, frames):
+      dest = os.path.join(directory, 'video-{0:06d}.png'.format(frame_time))
+      if isinstance(frame, basestring):
+        os.rename(frame, dest)
+        spilled_count += 1
+      else:
+        memory_frames[dest] = frame
+      ok = True
+    for frame in frames[len(frame_times):]:
+      if isinstance(frame, basestring):
+        os.remove(frame)
+    if spilled_count:
+      logging.info('Memory budget exceeded, {0:d} of {1:d} frames were written to disk'.format(spilled_count,
+                                                                                              len(frame_times)))
+
+  return ok
+
+
+def get_extract_filter(decimate, full_resolution, viewport):
+  crop = ''
+  if viewport is not None:
+    crop = 'crop={0}:{1}:{2}:{3},'.format(viewport['width'], viewport['height'], viewport['x'], viewport['y'])
+  scale = 'scale=iw*min(400/iw\,400/ih):ih*min(400/iw\,400/ih),'
+  if full_resolution:
+    scale = ''
+  return crop + scale + decimate + '=0:64:640:0.001'
+
+
+def get_frame_times(lines):
+  frame_times = []
+  match = re.compile('keep pts:[0-9]+ pts_time:(?P<timecode>[0-9\.]+)')
+  for line in lines:
+    m = re.search(match, line)
+    if m:
+      frame_times.append(int(math.ceil(float(m.groupdict().get('timecode')) * 1000)))
+  return frame_times
+
+
 def split_videos(directory, orange_file):
+  # Returns the video directories and the orange classification of every frame moved into them
   logging.debug("Splitting video on orange frames (this may take a while)...")
   directories = []
+  classified = {}
   current = 0
   found_orange = False
   video_dir = None
-  frames = sorted(glob.glob(os.path.join(directory, 'video-*.png')))
+  frames = list_frames(directory, 'video-*.png')
   if len(frames):
-    for frame in frames:
-      if is_orange_frame(frame, orange_file):
+    orange = find_orange_frames(frames, orange_file)
+    for frame, is_orange in zip(frames, orange):
+      if is_orange:
         if not found_orange:
           found_orange = True
           # Make a copy of the orange frame for the end of the current video
           if video_dir is not None:
             dest = os.path.join(video_dir, os.path.basename(frame))
-            shutil.copyfile(frame, dest)
+            copy_frame(frame, dest)
+            classified[dest] = True
           current += 1
           video_dir = os.path.join(directory, str(current))
           logging.debug("Orange frame found: " + frame + ", starting video directory: " + video_dir)
@@ -168,63 +461,71 @@ def split_videos(directory, orange_file):
         found_orange = False
       if video_dir is not None:
         dest = os.path.join(video_dir, os.path.basename(frame))
-        os.rename(frame, dest)
+        move_frame(frame, dest)
+        classified[dest] = is_orange
       else:
         logging.debug("Removing spurious frame " + frame + " at the beginning")
-        os.remove(frame)
-  return directories
+        remove_frame(frame)
+  return directories, classified
 
 
-def remove_frames_before_orange(directory, orange_file):
-  frames = sorted(glob.glob(os.path.join(directory, 'video-*.png')))
+def remove_frames_before_orange(frames, orange):
+  # Takes the frames with their orange classification from find_orange_frames and returns the ones that are kept
   if len(frames):
     # go through the first 20 frames and remove any that come before the first orange frame.
     # iOS video capture starts with a blank white frame and then flips to orange before starting.
     logging.debug("Scanning for non-orange frames...")
     found_orange = False
-    remove_frames = []
+    remove_count = 0
     frame_count = 0
-    for frame in frames:
+    for frame, is_orange in zip(frames, orange):
       frame_count += 1
-      if is_orange_frame(frame, orange_file):
+      if is_orange:
         found_orange = True
         break
       if frame_count > 20:
         break
-      remove_frames.append(frame)
+      remove_count += 1
 
-    if found_orange and len(remove_frames):
-      for frame in remove_frames:
+    if found_orange and remove_count:
+      for frame in frames[:remove_count]:
         logging.debug("Removing pre-orange frame {0}".format(frame ))
-        os.remove(frame)
+        remove_frame(frame)
+      return frames[remove_count:], orange[remove_count:]
+  return frames, orange
 
-def remove_orange_frames(directory, orange_file):
-  frames = sorted(glob.glob(os.path.join(directory, 'video-*.png')))
+def remove_orange_frames(frames, orange):
+  # Takes the frames with their orange classification from find_orange_frames and returns the ones that are kept
+  removed = set()
   if len(frames):
     # go through the first 20 frames and remove any orange ones. Unfortunately
     # sometimes the video blinks from orange to white and back to orange as Chrome flips in
     # an old render surface. Orange frames from the middle need to be dropped silently.
     logging.debug("Scanning for orange frames...")
     frame_count = 0
-    for frame in frames:
+    for frame, is_orange in zip(frames, orange):
       frame_count += 1
-      if is_orange_frame(frame, orange_file):
+      if is_orange:
         logging.debug("Removing Orange frame: " + frame)
-        os.remove(frame)
+        remove_frame(frame)
+        removed.add(frame)
       if frame_count > 20:
         break
-    for frame in reversed(frames):
-      if is_orange_frame(frame, orange_file):
-        logging.debug("Removing orange frame " + frame + " from the end")
-        os.remove(frame)
+    for frame, is_orange in reversed(zip(frames, orange)):
+      if is_orange:
+        if frame not in removed:
+          logging.debug("Removing orange frame " + frame + " from the end")
+          remove_frame(frame)
+          removed.add(frame)
       else:
         break
+  return [frame for frame in frames if frame not in removed], \
+         [is_orange for frame, is_orange in zip(frames, orange) if frame not in removed]
 
 
 def find_image_viewport(file):
   try:
-    from PIL import Image
-    im = Image.open(file)
+    im = open_frame_image(file)
     width, height = im.size
     x = int(math.floor(width / 2))
     y = int(math.floor(height / 2))
@@ -352,7 +653,7 @@ def find_video_viewport(video, directory, find_viewport, viewport_time):
 def trim_video_end(directory, trim_time):
   if trim_time > 0:
     logging.debug("Trimming " + str(trim_time) + "ms from the end of the video in " + directory)
-    frames = sorted(glob.glob(os.path.join(directory, 'video-*.png')))
+    frames = list_frames(directory, 'video-*.png')
     if len(frames):
       match = re.compile('video-(?P<ms>[0-9]+)\.png')
       m = re.search(match, frames[-1])
@@ -366,12 +667,12 @@ def trim_video_end(directory, trim_time):
             frame_time = int(m.groupdict().get('ms'))
             if frame_time > end_time:
               logging.debug("Trimming frame " + frame)
-              os.remove(frame)
+              remove_frame(frame)
 
 
 def adjust_frame_times(directory):
   offset = None
-  frames = sorted(glob.glob(os.path.join(directory, 'video-*.png')))
+  frames = list_frames(directory, 'video-*.png')
   if len(frames):
     match = re.compile('video-(?P<ms>[0-9]+)\.png')
     for frame in frames:
@@ -382,26 +683,24 @@ def adjust_frame_times(directory):
           offset = frame_time
         new_time = frame_time - offset
         dest = os.path.join(directory, 'ms_{0:06d}.png'.format(new_time))
-        os.rename(frame, dest)
+        move_frame(frame, dest)
 
 
 def find_first_frame(directory):
   global options
   try:
     if options.findstart > 0 and options.findstart <= 100:
-      files = sorted(glob.glob(os.path.join(directory, 'video-*.png')))
+      files = list_frames(directory, 'video-*.png')
       count = len(files)
       if count > 1:
-        from PIL import Image
         blank = files[0]
-        with Image.open(blank) as im:
-          width, height = im.size
+        width, height = get_frame_size(blank)
         match_height = int(math.ceil(height * options.findstart / 100.0))
         crop = '{0:d}x{1:d}+{2:d}+{3:d}'.format(width, match_height, 0, 0)
         for i in xrange(count):
           different = not frames_match(files[i], files[i + 1], 5, 100, crop, None)
           logging.debug('Removing early frame {0} from the beginning'.format(files[i]))
-          os.remove(files[i])
+          remove_frame(files[i])
           if different:
             break
   except:
@@ -413,13 +712,11 @@ def find_render_start(directory):
   global client_viewport
   try:
     if options.renderignore > 0 and options.renderignore <= 100:
-      files = sorted(glob.glob(os.path.join(directory, 'video-*.png')))
+      files = list_frames(directory, 'video-*.png')
       count = len(files)
       if count > 1:
-        from PIL import Image
         first = files[0]
-        with Image.open(first) as im:
-          width, height = im.size
+        width, height = get_frame_size(first)
         mask = {}
         mask['width'] = int(math.floor(width * options.renderignore / 100))
         mask['height'] = int(math.floor(height * options.renderignore / 100))
@@ -444,7 +741,7 @@ def find_render_start(directory):
         for i in xrange(1, count):
           if frames_match(first, files[i], 10, 100, crop, mask):
             logging.debug('Removing pre-render frame {0}'.format(files[i]))
-            os.remove(files[i])
+            remove_frame(files[i])
           else:
             break
   except:
@@ -456,12 +753,10 @@ def eliminate_duplicate_frames(directory):
   global client_viewport
 
   try:
-    files = sorted(glob.glob(os.path.join(directory, 'ms_*.png')))
+    files = list_frames(directory, 'ms_*.png')
     if len(files) > 1:
-      from PIL import Image
       blank = files[0]
-      with Image.open(blank) as im:
-        width, height = im.size
+      width, height = get_frame_size(blank)
       if options.viewport and options.notification:
         if client_viewport['width'] == width and client_viewport['height'] == height:
           client_viewport = None
@@ -493,13 +788,13 @@ def eliminate_duplicate_frames(directory):
       for i in xrange(1, count):
         if frames_match(blank, files[i], 10, 0, crop, None):
           logging.debug('Removing duplicate frame {0} from the beginning'.format(files[i]))
-          os.remove(files[i])
+          remove_frame(files[i])
         else:
           break
 
       # Do another pass looking for the last frame but with an allowance for up
       # to a 10% difference in individual pixels to deal with noise around text.
-      files = sorted(glob.glob(os.path.join(directory, 'ms_*.png')))
+      files = list_frames(directory, 'ms_*.png')
       count = len(files)
       duplicates = []
       if count > 2:
@@ -512,13 +807,13 @@ def eliminate_duplicate_frames(directory):
               duplicates.append(previous_frame)
             else:
               logging.debug('Removing duplicate frame {0} from the end'.format(previous_frame))
-              os.remove(previous_frame)
+              remove_frame(previous_frame)
             previous_frame = files[i]
           else:
             break
       for duplicate in duplicates:
         logging.debug('Removing duplicate frame {0} from the end'.format(duplicate))
-        os.remove(duplicate)
+        remove_frame(duplicate)
 
   except:
     logging.exception('Error processing frames for duplicates')
@@ -530,7 +825,7 @@ def eliminate_similar_frames(directory):
   try:
     # only do this when decimate couldn't be used to eliminate similar frames
     if options.notification:
-      files = sorted(glob.glob(os.path.join(directory, 'ms_*.png')))
+      files = list_frames(directory, 'ms_*.png')
       count = len(files)
       if count > 3:
         crop = None
@@ -541,7 +836,7 @@ def eliminate_similar_frames(directory):
         for i in xrange(2, count - 1):
           if frames_match(baseline, files[i], 1, 0, crop, None):
             logging.debug('Removing similar frame {0}'.format(files[i]))
-            os.remove(files[i])
+            remove_frame(files[i])
           else:
             baseline = files[i]
   except:
@@ -550,37 +845,58 @@ def eliminate_similar_frames(directory):
 
 def blank_first_frame(directory):
   global options
+  global memory_frames
   try:
     if options.forceblank:
-      files = sorted(glob.glob(os.path.join(directory, 'ms_*.png')))
+      files = list_frames(directory, 'ms_*.png')
       count = len(files)
       if count > 1:
-        from PIL import Image
-        with Image.open(files[0]) as im:
-          width, height = im.size
-        command = 'convert -size {0}x{1} xc:white PNG24:"{2}"'.format(width, height, files[0])
-        subprocess.call(command, shell=True)
+        width, height = get_frame_size(files[0])
+        if files[0] in memory_frames:
+          import numpy
+          memory_frames[files[0]] = numpy.full((height, width, 3), 255, dtype=numpy.uint8)
+        else:
+          command = 'convert -size {0}x{1} xc:white PNG24:"{2}"'.format(width, height, files[0])
+          subprocess.call(command, shell=True)
   except:
     logging.exception('Error blanking first frame')
 
 
 def crop_viewport(directory):
   global client_viewport
+  global memory_frames
   if client_viewport is not None:
     try:
-      files = sorted(glob.glob(os.path.join(directory, 'ms_*.png')))
+      files = list_frames(directory, 'ms_*.png')
       count = len(files)
       if count > 0:
         crop = '{0:d}x{1:d}+{2:d}+{3:d}'.format(client_viewport['width'], client_viewport['height'],
                                                 client_viewport['x'], client_viewport['y'])
         for i in xrange(count):
-          command = 'convert "{0}" -crop {1} "{0}"'.format(files[i], crop)
-          subprocess.call(command, shell=True)
+          if files[i] in memory_frames:
+            memory_frames[files[i]] = crop_pixels(memory_frames[files[i]], crop)
+          else:
+            command = 'convert "{0}" -crop {1} "{0}"'.format(files[i], crop)
+            subprocess.call(command, shell=True)
 
     except:
       logging.exception('Error cropping to viewport')
 
 
+def stream_frames(options):
+  if options is None or not options.stream:
+    return False
+  try:
+    import numpy
+  except ImportError:
+    logging.warning('NumPy is not available, extracting frames to disk instead of streaming them')
+    return False
+  if options.compare == 'imagemagick':
+    logging.warning('Frames compared with ImageMagick need to be on disk, not streaming them')
+    return False
+  return True
+
+
 def get_decimate_filter():
   decimate = None
   try:
@@ -610,7 +926,52 @@ def clean_directory(directory):
     os.remove(file)
 
 
+def find_orange_frames(frames, orange_file, classified=None):
+  # Classifies the frames in a single pass, returning an orange/not orange flag per frame for the frame removal
+  # functions. Frames already in classified (path -> flag, from split_videos) are not classified again.
+  orange = []
+  for frame in frames:
+    if classified is not None and frame in classified:
+      orange.append(classified[frame])
+    else:
+      orange.append(is_orange_frame(frame, orange_file))
+  return orange
+
+
 def is_orange_frame(file, orange_file):
+  global options
+  orange = None
+  if options is None or options.compare != 'imagemagick':
+    orange = is_orange_frame_native(file, orange_file)
+  if orange is None:
+    orange = is_orange_frame_imagemagick(file, orange_file)
+  return orange
+
+
+def is_orange_frame_native(file, orange_file):
+  # Same comparison as the ImageMagick version: the center 50x33% of the frame is resized to the size of the orange
+  # reference image and the frame is orange if less than 100 pixels differ by more than 10%.
+  if not os.path.isfile(orange_file):
+    return False
+  pixels = load_image_array(file)
+  orange = load_image_array(orange_file)
+  if pixels is None or orange is None:
+    return None
+
+  from PIL import Image
+
+  height, width = pixels.shape[:2]
+  crop_width = int(math.floor(width * 50 / 100.0 + 0.5))
+  crop_height = int(math.floor(height * 33 / 100.0 + 0.5))
+  x = (width - crop_width) / 2
+  y = (height - crop_height) / 2
+  center = Image.fromarray(pixels[y:y + crop_height, x:x + crop_width])
+  orange_height, orange_width = orange.shape[:2]
+  center = decode_pil_array(center.resize((orange_width, orange_height), Image.ANTIALIAS))
+  return count_array_differences(center, orange, 10) < 100
+
+
+def is_orange_frame_imagemagick(file, orange_file):
   orange = False
   if os.path.isfile(orange_file):
     command = ('convert "{0}" "(" "{1}" -gravity Center -crop 50x33%+0+0 -resize 200x200! ")" miff:- | '
@@ -625,6 +986,29 @@ def is_orange_frame(file, orange_file):
   return orange
 
 
+def decode_image_array(file):
+  # Decodes an RGB(A) frame into a read-only height x width x 3 uint8 array. Returns None when NumPy is not
+  # installed or the frame uses another color mode so callers can fall back to the pixel-by-pixel paths.
+  try:
+    from PIL import Image
+    with Image.open(file) as im:
+      return decode_pil_array(im)
+  except Exception:
+    return None
+
+
+def decode_pil_array(im):
+  try:
+    import numpy
+  except ImportError:
+    return None
+  if im.mode not in ('RGB', 'RGBA'):
+    return None
+  pixels = numpy.ascontiguousarray(numpy.asarray(im)[:, :, :3])
+  pixels.flags.writeable = False
+  return pixels
+
+
 def colors_are_similar(a, b):
   similar = True
   for x in xrange(3):
@@ -635,7 +1019,62 @@ def colors_are_similar(a, b):
 
 
 def frames_match(image1, image2, fuzz_percent, max_differences, crop_region, mask_rect):
-  match = False
+  global options
+  different_pixels = None
+  if options is None or options.compare != 'imagemagick':
+    different_pixels = count_different_pixels(image1, image2, fuzz_percent, crop_region, mask_rect)
+  if different_pixels is None:
+    different_pixels = count_different_pixels_imagemagick(image1, image2, fuzz_percent, crop_region, mask_rect)
+  return different_pixels is not None and different_pixels <= max_differences
+
+
+def count_different_pixels(image1, image2, fuzz_percent, crop_region, mask_rect):
+  # In-memory equivalent of "compare -metric AE -fuzz X%": a pixel is different when the euclidean distance
+  # between the two RGB values is larger than the fuzz distance. Returns None if the frames can't be compared
+  # in memory, in which case the ImageMagick path is used.
+  pixels1 = load_image_array(image1)
+  pixels2 = load_image_array(image2)
+  if pixels1 is None or pixels2 is None or pixels1.shape != pixels2.shape:
+    return None
+
+  if mask_rect is not None:
+    pixels1 = mask_pixels(pixels1, mask_rect)
+    pixels2 = mask_pixels(pixels2, mask_rect)
+  if crop_region is not None:
+    pixels1 = crop_pixels(pixels1, crop_region)
+    pixels2 = crop_pixels(pixels2, crop_region)
+
+  return count_array_differences(pixels1, pixels2, fuzz_percent)
+
+
+def count_array_differences(pixels1, pixels2, fuzz_percent):
+  import numpy
+
+  diff = pixels1.astype(numpy.int32) - pixels2.astype(numpy.int32)
+  distance = (diff * diff).sum(axis=2)
+  fuzz = 255.0 * fuzz_percent / 100.0
+  return int(numpy.count_nonzero(distance > fuzz * fuzz))
+
+
+def mask_pixels(pixels, mask_rect):
+  # Same as compositing a white rectangle of the mask size over the image
+  pixels = pixels.copy()
+  x = max(mask_rect['x'], 0)
+  y = max(mask_rect['y'], 0)
+  pixels[y:mask_rect['y'] + mask_rect['height'], x:mask_rect['x'] + mask_rect['width']] = 255
+  return pixels
+
+
+def crop_pixels(pixels, crop_region):
+  m = re.match('^(?P<width>[0-9]+)x(?P<height>[0-9]+)\+(?P<x>[0-9]+)\+(?P<y>[0-9]+)$', crop_region)
+  if m is None:
+    raise ValueError('Unsupported crop geometry ' + crop_region)
+  width, height, x, y = [int(m.group(g)) for g in ('width', 'height', 'x', 'y')]
+  return pixels[y:y + height, x:x + width]
+
+
+def count_different_pixels_imagemagick(image1, image2, fuzz_percent, crop_region, mask_rect):
+  different_pixels = None
   fuzz = ''
   if fuzz_percent > 0:
     fuzz = '-fuzz {0:d}% '.format(fuzz_percent)
@@ -657,12 +1096,10 @@ def frames_match(image1, image2, fuzz_percent, max_differences, crop_region, mas
   out, err = compare.communicate()
   if re.match('^[0-9]+$', err):
     different_pixels = int(err)
-    if different_pixels <= max_differences:
-      match = True
   else:
     logging.debug('Unexpected compare result: out: "{0}", err: "{1}"'.format(out, err))
 
-  return match
+  return different_pixels
 
 
 def generate_orange_png(orange_file):
@@ -681,7 +1118,7 @@ def generate_orange_png(orange_file):
 def synchronize_to_timeline(directory, timeline_file):
   offset = get_timeline_offset(timeline_file)
   if offset > 0:
-    frames = sorted(glob.glob(os.path.join(directory, 'ms_*.png')))
+    frames = list_frames(directory, 'ms_*.png')
     match = re.compile('ms_(?P<ms>[0-9]+)\.png')
     for frame in frames:
       m = re.search(match, frame)
@@ -690,9 +1127,9 @@ def synchronize_to_timeline(directory, timeline_file):
         new_time = max(frame_time - offset, 0)
         dest = os.path.join(directory, 'ms_{0:06d}.png'.format(new_time))
         if frame != dest:
-          if os.path.isfile(dest):
-            os.remove(dest)
-          os.rename(frame, dest)
+          if frame_exists(dest):
+            remove_frame(dest)
+          move_frame(frame, dest)
 
 
 def get_timeline_offset(timeline_file):
@@ -832,7 +1269,31 @@ def calculate_histograms(directory, histograms_file, force):
 
 
 def calculate_image_histogram(file):
+  global frame_histograms
+  entry = frame_histograms.pop(file, None)
+  if entry is not None:
+    stat = os.stat(file)
+    if entry[0] == (stat.st_mtime, stat.st_size):
+      return entry[1]
   logging.debug('Calculating histogram for ' + file)
+  pixels = load_image_array(file)
+  if pixels is not None:
+    return calculate_array_histogram(pixels)
+  return calculate_image_histogram_python(file)
+
+
+def calculate_array_histogram(pixels):
+  import numpy
+
+  pixels = pixels.reshape(-1, 3)
+  # Don't include White pixels (with a tiny bit of slop for compression artifacts)
+  pixels = pixels[(pixels < 250).any(axis=1)]
+  return {'r': numpy.bincount(pixels[:, 0], minlength=256).tolist(),
+          'g': numpy.bincount(pixels[:, 1], minlength=256).tolist(),
+          'b': numpy.bincount(pixels[:, 2], minlength=256).tolist()}
+
+
+def calculate_image_histogram_python(file):
   try:
     from PIL import Image
 
@@ -885,7 +1346,7 @@ def convert_to_jpeg(directory, quality):
 ########################################################################################################################
 def cap_frame_count(directory, maxframes):
   directory = os.path.realpath(directory)
-  frames = sorted(glob.glob(os.path.join(directory, 'ms_*.png')))
+  frames = list_frames(directory, 'ms_*.png')
   frame_count = len(frames)
   if frame_count > maxframes:
     # First pass, sample all video frames at 10fps instead of 60fps, keeping the first 20% of the target
@@ -893,7 +1354,7 @@ def cap_frame_count(directory, maxframes):
     skip_frames = int(maxframes * 0.2)
     sample_frames(frames, 100, 0, skip_frames)
 
-    frames = sorted(glob.glob(os.path.join(directory, 'ms_*.png')))
+    frames = list_frames(directory, 'ms_*.png')
     frame_count = len(frames)
     if frame_count > maxframes:
       # Second pass, sample all video frames after the first 5 seconds at 2fps, keeping the first 40% of the target
@@ -901,7 +1362,7 @@ def cap_frame_count(directory, maxframes):
       skip_frames = int(maxframes * 0.4)
       sample_frames(frames, 500, 5000, skip_frames)
 
-      frames = sorted(glob.glob(os.path.join(directory, 'ms_*.png')))
+      frames = list_frames(directory, 'ms_*.png')
       frame_count = len(frames)
       if frame_count > maxframes:
         # Third pass, sample all video frames after the first 10 seconds at 1fps, keeping the first 60% of the target
@@ -942,7 +1403,7 @@ def sample_frames(frames, interval, start_ms, skip_frames):
                 frame != last_frame and
                 frame_count > skip_frames):
           logging.debug('Removing sampled frame ' + frame)
-          os.remove(frame)
+          remove_frame(frame)
         last_bucket = frame_bucket
 
 
@@ -1006,17 +1467,59 @@ def load_histograms(histograms_file, start, end):
 
 
 def calculate_visual_progress(histograms):
+  try:
+    values = calculate_progress_array(histograms_to_array(histograms))
+  except ImportError:
+    values = calculate_visual_progress_python(histograms)
   progress = []
-  first = histograms[0]['histogram']
-  last = histograms[-1]['histogram']
-  for index, histogram in enumerate(histograms):
-    p = calculate_frame_progress(histogram['histogram'], first, last)
+  for histogram, p in zip(histograms, values):
     progress.append({'time': histogram['time'],
                      'progress': p})
     logging.debug('{0:d}ms - {1:d}% Complete'.format(histogram['time'], int(p)))
   return progress
 
 
+def calculate_visual_progress_python(histograms):
+  first = histograms[0]['histogram']
+  last = histograms[-1]['histogram']
+  return [calculate_frame_progress(histogram['histogram'], first, last) for histogram in histograms]
+
+
+def histograms_to_array(histograms):
+  # (frames x channels x buckets) array of all the histograms
+  import numpy
+
+  channels = ['r', 'g', 'b']
+  return numpy.array([[histogram['histogram'][channel] for channel in channels] for histogram in histograms],
+                     dtype=numpy.int64)
+
+
+def calculate_progress_array(histograms):
+  # Same matching as calculate_frame_progress, but every frame is advanced through the buckets in lock-step so each
+  # step is a single operation over all of the frames. The first and last frames are the start and final histograms.
+  import numpy
+
+  slop = 5  # allow for matching slight color variations
+  frame_count, channel_count, buckets = histograms.shape
+  start = histograms[0]
+  final = histograms[-1]
+  total = 0
+  matched = numpy.zeros(frame_count, dtype=numpy.int64)
+  for channel in xrange(channel_count):
+    available = numpy.abs(histograms[:, channel, :] - start[channel]).T.copy()
+    targets = numpy.abs(final[channel] - start[channel])
+    for i in numpy.flatnonzero(targets):
+      target = numpy.full(frame_count, targets[i], dtype=numpy.int64)
+      total += int(targets[i])
+      for j in xrange(max(0, i - slop), min(buckets, i + slop)):
+        this_match = numpy.minimum(target, available[j])
+        available[j] -= this_match
+        matched += this_match
+        target -= this_match
+  # Finish in Python floats so the rounding is identical to calculate_frame_progress
+  return [math.floor((float(m) / float(total)) * 100) if total else 100.0 for m in matched.tolist()]
+
+
 def calculate_frame_progress(histogram, start, final):
   total = 0;
   matched = 0;
@@ -1133,6 +1636,14 @@ def check_config():
     print 'FAIL'
     ok = False
 
+  print 'NumPy:   ',
+  try:
+    import numpy
+
+    print 'OK'
+  except:
+    print 'MISSING (optional, pure Python frame processing will be used)'
+
   print 'SSIM:    ',
   try:
     from ssim import compute_ssim
@@ -1164,6 +1675,7 @@ def check_process(command, output):
 def main():
   import argparse
   global options
+  global frame_cache
 
   parser = argparse.ArgumentParser(description='Calculate visual performance metrics from a video.',
                                    prog='visualmetrics')
@@ -1216,6 +1728,15 @@ def main():
                       help="Calculate perceptual Speed Index")
   parser.add_argument('-j', '--json', action='store_true', default=False,
                       help="Set output format to JSON")
+  parser.add_argument('--stream', action='store_true', default=False,
+                      help="Stream raw frames from ffmpeg and process them in memory, only writing the frames that "
+                           "are kept to disk (requires NumPy).")
+  parser.add_argument('--cachesize', type=int, default=256,
+                      help="Memory (in MB) used to keep decoded video frames between the processing stages "
+                           "(0 disables the cache).")
+  parser.add_argument('--compare', choices=['native', 'imagemagick'], default='native',
+                      help="Engine used for frame comparisons. The native engine compares decoded frames in memory "
+                           "(requires NumPy) and falls back to ImageMagick when it can't be used.")
 
   options = parser.parse_args()
 
@@ -1251,6 +1772,9 @@ def main():
   if options.multiple:
     options.orange = True
 
+  if options.cachesize > 0:
+    frame_cache = FrameCache(options.cachesize * 1024 * 1024)
+
   ok = False
   try:
     if not options.check:
@@ -1290,6 +1814,9 @@ def main():
     logging.exception(e)
     ok = False
 
+  if frame_cache is not None:
+    logging.info('Frame cache: {0:d} hits, {1:d} misses'.format(frame_cache.hits, frame_cache.misses))
+
   # Clean up
   shutil.rmtree(temp_dir)
   if ok:
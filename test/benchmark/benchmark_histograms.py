@@ -0,0 +1,70 @@
+#!/usr/bin/python
+import argparse
+import imp
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+#
+# benchmark_histograms.py [-h] [--frames N] [--width W] [--height H]
+#
+# Compares the vectorized histogram calculation against the pure Python implementation on synthetic frames.
+#
+
+visualmetrics = imp.load_source("visualmetrics", os.path.join(os.path.dirname(__file__), "..", "..",
+                                                               "lib", "video", "visualmetrics.py"))
+
+
+def generate_frames(directory, count, size):
+    rnd = random.Random(0)
+    frames = []
+    for i in range(count):
+        im = Image.new("RGB", size, (255, 255, 255))
+        draw = ImageDraw.Draw(im)
+        # Progressively "render" more blocks of content onto a white page
+        for block in range(i * 4):
+            x, y = rnd.randint(0, size[0]), rnd.randint(0, size[1])
+            color = (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+            draw.rectangle([x, y, x + size[0] / 8, y + size[1] / 16], fill=color)
+        del draw
+        path = os.path.join(directory, "ms_{0:06d}.png".format(i * 100))
+        im.save(path)
+        frames.append(path)
+    return frames
+
+
+def measure(fn, frames):
+    start = time.time()
+    results = [fn(f) for f in frames]
+    return time.time() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Histogram benchmark', prog='benchmark_histograms.py')
+    parser.add_argument('--frames', type=int, default=10)
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=768)
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_hist_')
+    try:
+        frames = generate_frames(directory, options.frames, (options.width, options.height))
+
+        python_time, python_results = measure(visualmetrics.calculate_image_histogram_python, frames)
+        array_time, array_results = measure(visualmetrics.calculate_image_histogram, frames)
+
+        print("Frames:     %d at %dx%d" % (options.frames, options.width, options.height))
+        print("Python:     %.3fs (%.1f frames/s)" % (python_time, options.frames / python_time))
+        print("Vectorized: %.3fs (%.1f frames/s)" % (array_time, options.frames / array_time))
+        print("Speedup:    %.1fx" % (python_time / array_time))
+        print("Identical:  %r" % (python_results == array_results))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
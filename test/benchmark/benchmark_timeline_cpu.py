@@ -0,0 +1,94 @@
+#!/usr/bin/python
+import argparse
+import imp
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+#
+# benchmark_timeline_cpu.py [-h] [--events N] [--names N] [--duration MS]
+#
+# Compares the dense array CPU slice accounting against the per-slice Python implementation on a synthetic trace with
+# nested events and checks that both produce the same timeline_cpu output.
+#
+
+trace_parser = imp.load_source("trace_parser", os.path.join(os.path.dirname(__file__), "..", "..",
+                                                              "lib", "trace", "trace-parser.py"))
+
+
+def generate_trace(path, count, name_count, duration):
+    rnd = random.Random(0)
+    names = ['Event%d' % i for i in range(name_count)]
+    events = [{'cat': 'devtools.timeline', 'name': 'ResourceSendRequest', 'ph': 'X', 'pid': 1, 'tid': 2, 'ts': 0,
+               'dur': 1, 'args': {'data': {'url': 'http://example.com/'}}}]
+    end = duration * 1000
+    for tid in [2, 3]:
+        ts = 0
+        while len(events) < count * tid / 3 and ts < end:
+            # A top level task with a few levels of nested work inside of it
+            length = rnd.choice([rnd.randint(10, 2000), rnd.randint(2000, 200000)])
+            events.append({'cat': 'devtools.timeline', 'name': rnd.choice(names), 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': ts, 'dur': length})
+            child = ts
+            while child < ts + length and len(events) < count * tid / 3:
+                child_length = rnd.randint(1, max(1, (ts + length - child) / 2))
+                events.append({'cat': 'devtools.timeline', 'name': rnd.choice(names), 'ph': 'B', 'pid': 1,
+                               'tid': tid, 'ts': child})
+                events.append({'cat': 'devtools.timeline', 'name': rnd.choice(names), 'ph': 'X', 'pid': 1,
+                               'tid': tid, 'ts': child, 'dur': max(1, child_length / 3)})
+                events.append({'cat': 'devtools.timeline', 'name': events[-2]['name'], 'ph': 'E', 'pid': 1,
+                               'tid': tid, 'ts': child + child_length})
+                child += child_length + rnd.randint(0, 50)
+            ts += length + rnd.randint(0, 5000)
+    events.sort(key=lambda e: e['ts'])
+    with open(path, 'w') as f:
+        f.write("[\n" + ",\n".join(json.dumps(e) for e in events) + "\n]")
+    return len(events)
+
+
+def python_slices(*args):
+    raise ImportError()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Timeline CPU slice benchmark', prog='benchmark_timeline_cpu.py')
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--names', type=int, default=40)
+    parser.add_argument('--duration', type=int, default=60000, help="Length of the trace in milliseconds")
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_cpu_')
+    try:
+        path = os.path.join(directory, 'trace.json')
+        count = generate_trace(path, options.events, options.names, options.duration)
+
+        trace = trace_parser.Trace()
+        trace.Process(path)
+
+        start = time.time()
+        trace.ProcessTimelineSlices = python_slices
+        trace.ProcessTimelineEvents()
+        python_time = time.time() - start
+        python_cpu = json.dumps(trace.cpu, sort_keys=True)
+
+        del trace.ProcessTimelineSlices
+        start = time.time()
+        trace.ProcessTimelineEvents()
+        array_time = time.time() - start
+        array_cpu = json.dumps(trace.cpu, sort_keys=True)
+
+        print("Events:     %d, %d slices of %dus" % (count, len(trace.cpu['slices'].values()[0].values()[0]),
+                                                     trace.cpu['slice_usecs']))
+        print("Python:     %.3fs" % python_time)
+        print("Arrays:     %.3fs" % array_time)
+        print("Speedup:    %.1fx" % (python_time / array_time))
+        print("Identical:  %r" % (python_cpu == array_cpu))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
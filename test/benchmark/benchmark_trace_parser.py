@@ -0,0 +1,118 @@
+#!/usr/bin/python
+import argparse
+import gzip
+import imp
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+#
+# benchmark_trace_parser.py [-h] [--events N] [--legacy]
+#
+# Measures events/s and peak RSS when reading synthetic traces in each of the supported layouts. Every measurement
+# runs in its own process so the peak RSS is not affected by the others.
+#
+
+trace_parser = imp.load_source("trace_parser", os.path.join(os.path.dirname(__file__), "..", "..",
+                                                              "lib", "trace", "trace-parser.py"))
+
+NAMES = ['Layout', 'Paint', 'FunctionCall', 'EvaluateScript', 'ParseHTML', 'RecalculateStyles']
+
+
+def generate_events(count):
+    rnd = random.Random(0)
+    yield {'cat': 'devtools.timeline', 'name': 'ResourceSendRequest', 'ph': 'X', 'pid': 1, 'tid': 2, 'ts': 1000,
+           'dur': 1, 'args': {'data': {'url': 'http://example.com/', 'requestId': '1.1'}}}
+    ts = 1000
+    for i in range(count - 1):
+        ts += rnd.randint(1, 200)
+        yield {'cat': 'disabled-by-default-devtools.timeline,devtools.timeline', 'name': rnd.choice(NAMES),
+               'ph': 'X', 'pid': 1, 'tid': rnd.choice([2, 2, 2, 3]), 'ts': ts, 'dur': rnd.randint(1, 400),
+               'args': {'data': {'frame': '0x1a2b3c', 'stackTrace': [{'url': 'http://example.com/app.js',
+                                                                      'lineNumber': i % 1000}]}}}
+
+
+def write_trace(path, layout, count):
+    f = gzip.open(path, 'wb') if path.endswith('.gz') else open(path, 'wb')
+    if layout == 'object':
+        f.write('{"traceEvents": [\n')
+    else:
+        f.write('[\n')
+    first = True
+    for event in generate_events(count):
+        if not first:
+            f.write(',\n')
+        f.write(json.dumps(event))
+        first = False
+    f.write('\n]')
+    if layout == 'object':
+        f.write(', "metadata": {}}')
+    f.close()
+
+
+def read_streaming(path):
+    f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'r')
+    count = 0
+    for event in trace_parser.TraceReader(f).Events():
+        count += 1
+    f.close()
+    return count
+
+
+def read_legacy(path):
+    # What reading a "traceEvents" object used to cost: the whole trace materialized by json.load
+    f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'r')
+    count = len(json.load(f)['traceEvents'])
+    f.close()
+    return count
+
+
+def measure(fn, path, results):
+    start = time.time()
+    count = fn(path)
+    elapsed = time.time() - start
+    results.put((count, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def run(fn, path):
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=measure, args=(fn, path, results))
+    p.start()
+    result = results.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trace reading benchmark', prog='benchmark_trace_parser.py')
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--legacy', action='store_true', default=False,
+                        help="Also measure loading the traceEvents object with json.load")
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_trace_')
+    try:
+        print("%-26s %10s %8s %12s %14s" % ("Trace", "Size (MB)", "Time (s)", "Events/s", "Peak RSS (MB)"))
+        for name, layout in [('array.json', 'array'), ('array.json.gz', 'array'),
+                             ('object.json', 'object'), ('object.json.gz', 'object')]:
+            path = os.path.join(directory, name)
+            write_trace(path, layout, options.events)
+            size = os.path.getsize(path) / 1024.0 / 1024.0
+            tests = [(name, read_streaming)]
+            if options.legacy and layout == 'object':
+                tests.append((name + " (json.load)", read_legacy))
+            for label, fn in tests:
+                count, elapsed, rss = run(fn, path)
+                print("%-26s %10.1f %8.2f %12.0f %14.1f" % (label, size, elapsed, count / elapsed, rss / 1024.0))
+            os.remove(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
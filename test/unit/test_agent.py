@@ -1,8 +1,14 @@
+import shutil
+import tempfile
+import threading
 import unittest
 import os
 
-from client.agent import Agent
+import mock
+
+from client.agent import Agent, PollScheduler
 from client.log import init_log
+from test_http_client import StandInServer, parse_multipart
 
 init_log(4)
 
@@ -11,7 +17,7 @@ class TestAgent(unittest.TestCase):
     def test_writes_job_file(self):
         s = "Test ID=160912_AD_1\nurl=http://www.ikea.com/ie/en/"
 
-        def run_job(job_id, result_dir):
+        def run_job(job_id, result_dir, slot):
             self.assertEqual("160912_AD_1", job_id)
             self.assertEqual(len(s), os.stat(os.path.join(result_dir.folder, "test.job")).st_size)
 
@@ -21,3 +27,188 @@ class TestAgent(unittest.TestCase):
     def test_poll(self):
         agent = Agent("http://localhost", "Location", run_job)
 
+
+class TestAgentSlots(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_agent(self, slots, jobs, run_job):
+        agent = Agent("http://localhost", "Location", run_job, slots=slots, work_dir=self.directory, upload=False)
+        agent.scheduler = PollScheduler(initial_interval=0.01, max_interval=0.01)
+        jobs = list(jobs)
+
+        def poll():
+            if len(jobs) == 0:
+                agent.stop()
+                return ""
+            return jobs.pop(0)
+
+        agent.poll = poll
+        return agent
+
+    def test_runs_jobs_concurrently_in_separate_slots(self):
+        lock = threading.Lock()
+        all_started = threading.Event()
+        started = []
+
+        def run_job(job_id, result_dir, slot):
+            with lock:
+                started.append((job_id, slot.index, result_dir.folder, slot.lockfile))
+                if len(started) == 2:
+                    all_started.set()
+            # Both jobs must be in flight at the same time to get past this point
+            if not all_started.wait(5):
+                raise Exception("Jobs were not run concurrently")
+
+        agent = self.create_agent(2, ["Test ID=1", "Test ID=2"], run_job)
+        agent.start()
+
+        self.assertTrue(all_started.is_set())
+        self.assertEqual([0, 1], sorted(s[1] for s in started))
+        for job_id, index, folder, lockfile in started:
+            self.assertEqual(os.path.join(self.directory, "slot-%d" % index), os.path.dirname(folder))
+            self.assertEqual(os.path.join(self.directory, "slot-%d.lock" % index), lockfile)
+
+    def test_does_not_poll_while_all_slots_are_busy(self):
+        lock = threading.Lock()
+        running = []
+        running_at_poll = []
+
+        def run_job(job_id, result_dir, slot):
+            with lock:
+                running.append(job_id)
+            threading.Event().wait(0.1)
+            with lock:
+                running.remove(job_id)
+
+        agent = self.create_agent(2, ["Test ID=1", "Test ID=2", "Test ID=3", "Test ID=4"], run_job)
+        poll = agent.poll
+
+        def counting_poll():
+            with lock:
+                running_at_poll.append(len(running))
+            return poll()
+
+        agent.poll = counting_poll
+        agent.start()
+
+        self.assertEqual(5, len(running_at_poll))
+        self.assertTrue(max(running_at_poll) < 2)
+
+    def test_waits_for_running_jobs_on_stop(self):
+        completed = []
+
+        def run_job(job_id, result_dir, slot):
+            agent.stop()
+            threading.Event().wait(0.2)
+            completed.append(job_id)
+
+        agent = self.create_agent(2, ["Test ID=1"], run_job)
+        agent.start()
+
+        self.assertEqual(["1"], completed)
+        self.assertEqual(2, agent.free_slots.qsize())
+
+
+class TestPollScheduler(unittest.TestCase):
+    def test_backs_off_exponentially_while_empty(self):
+        scheduler = PollScheduler(initial_interval=1, max_interval=10, jitter=0)
+
+        self.assertEqual([1, 2, 4, 8, 10, 10], [scheduler.empty() for i in range(6)])
+
+    def test_backs_off_on_errors(self):
+        scheduler = PollScheduler(initial_interval=1, max_interval=10, jitter=0)
+
+        self.assertEqual([1, 2, 4], [scheduler.error() for i in range(3)])
+
+    def test_polls_immediately_after_a_job(self):
+        scheduler = PollScheduler(initial_interval=1, max_interval=10, jitter=0)
+        scheduler.empty()
+        scheduler.empty()
+
+        self.assertEqual(0, scheduler.job_found())
+        self.assertEqual(1, scheduler.empty())
+
+    def test_jitter_shortens_the_interval(self):
+        scheduler = PollScheduler(initial_interval=8, max_interval=8, jitter=0.5)
+
+        for i in range(100):
+            self.assertTrue(4 <= scheduler.empty() <= 8)
+
+    def test_long_poll_does_not_back_off_when_empty(self):
+        scheduler = PollScheduler(initial_interval=1, max_interval=10, jitter=0, long_poll=True)
+
+        self.assertEqual([0, 0, 0], [scheduler.empty() for i in range(3)])
+        self.assertEqual(1, scheduler.error())
+
+
+class TestAgentPolling(unittest.TestCase):
+    def test_counts_polls(self):
+        results = ["Test ID=1", "", None, "Test ID=2", ""]
+
+        def poll():
+            res = results.pop(0)
+            if len(results) == 0:
+                agent.stop()
+            return res
+
+        agent = Agent("http://localhost", "Location", lambda job_id, result_dir, slot: None, upload=False)
+        agent.scheduler = PollScheduler(initial_interval=0.01, max_interval=0.01)
+        agent.poll = poll
+        agent.start()
+
+        self.assertEqual(5, agent.stats['polls'])
+        self.assertEqual(2, agent.stats['jobs'])
+        self.assertEqual(2, agent.stats['empty_polls'])
+        self.assertEqual(1, agent.stats['poll_errors'])
+        self.assertTrue(agent.stats['idle_time'] > 0)
+
+    def test_passes_hold_for_long_polls(self):
+        agent = Agent("http://localhost", "Location", None, hold=20)
+        agent.http.get = mock.Mock(return_value="")
+        agent.poll()
+
+        self.assertEqual(20, agent.http.get.call_args[0][1]['hold'])
+        self.assertEqual(50, agent.http.get.call_args[1]['timeout'])
+
+
+class TestAgentUpload(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_uploads_result_directory(self):
+        def run_job(job_id, result_dir, slot):
+            with result_dir.open_file("trace.json") as f:
+                f.write("[]")
+            os.mkdir(os.path.join(result_dir.folder, "video"))
+            with open(os.path.join(result_dir.folder, "video", "ms_000100.jpg"), "w") as f:
+                f.write("jpg")
+
+        agent = Agent(self.server.url, "Location", run_job)
+        agent.spawn_job("Test ID=160912_AD_1")
+
+        method, path, headers, body, address = self.server.requests[0]
+        self.assertEqual("/wpt/work/workdone.php", path)
+        form = parse_multipart(headers, body)
+        self.assertEqual("160912_AD_1", form.getfirst("id"))
+        self.assertEqual("Location", form.getfirst("location"))
+        self.assertEqual("1", form.getfirst("done"))
+        self.assertEqual({"trace.json": "[]", "video/ms_000100.jpg": "jpg"},
+                         dict((f.filename, f.value) for f in form["file"]))
+
+    def test_uploads_error_of_failed_job(self):
+        def run_job(job_id, result_dir, slot):
+            raise Exception("Browser crashed")
+
+        agent = Agent(self.server.url, "Location", run_job)
+        with self.assertRaises(Exception):
+            agent.spawn_job("Test ID=160912_AD_1")
+
+        method, path, headers, body, address = self.server.requests[0]
+        self.assertEqual("Browser crashed", parse_multipart(headers, body).getfirst("error"))
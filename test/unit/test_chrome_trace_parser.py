@@ -0,0 +1,95 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from client.browser.webdriver import chrome_webdriver
+from client.browser.webdriver.chrome_webdriver import ChromeTraceParser
+from client.capability import TraceCapability
+from client.log import init_log
+from client.model import ResultDirectory, Run, Session, Step, View
+from client.provider import EventDispatcher, Event
+
+init_log(4)
+
+TRACE = [
+    {'cat': 'devtools.timeline', 'name': 'ResourceSendRequest', 'ph': 'X', 'pid': 1, 'tid': 2, 'ts': 1000,
+     'args': {'data': {'url': 'http://example.com/'}}},
+    {'cat': 'devtools.timeline', 'name': 'Layout', 'ph': 'X', 'pid': 1, 'tid': 2, 'ts': 2000, 'dur': 500},
+    {'cat': 'blink.user_timing', 'name': 'mark', 'ph': 'R', 'pid': 1, 'tid': 2, 'ts': 3000}
+]
+
+
+class TestChromeTraceParser(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.result_dir = ResultDirectory(self.directory + "/result")
+        self.session = Session(2, self.result_dir)
+        self.provider = ChromeTraceParser(EventDispatcher(), {'lockfile': None, 'trace_workers': 2})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_session(self, traces):
+        self.provider.on_start_session(Event("StartSession", session=self.session))
+        for r in range(1, self.session.run_count + 1):
+            run = Run(r)
+            view = View(True, False)
+            self.provider.on_start_run(Event("StartRun", run=run))
+            self.provider.on_start_view(Event("StartView", view=view))
+            for s in range(1, 3):
+                step = Step(s, "Step %d" % s)
+                self.provider.on_start_step(Event("StartStep", step=step))
+                with TraceCapability(self.session).open_trace_file(run, view, step) as f:
+                    f.write(traces(run, step))
+                self.provider.on_stop_step(Event("StopStep", step=step))
+            self.provider.on_stop_view(Event("StopView", view=view))
+            self.provider.on_stop_run(Event("StopRun", run=run))
+        self.provider.on_stop_session(Event("StopSession", session=self.session))
+
+    def test_parses_all_traces_of_the_session(self):
+        self.run_session(lambda run, step: json.dumps(TRACE))
+
+        for name in ["1_user_timing.json.gz", "1_2_user_timing.json.gz", "2_user_timing.json.gz",
+                     "2_2_user_timing.json.gz"]:
+            with gzip.open(os.path.join(self.result_dir.folder, name)) as f:
+                self.assertEqual(["mark"], [e['name'] for e in json.load(f)])
+        for name in ["1_timeline_cpu.json.gz", "2_2_timeline_cpu.json.gz"]:
+            with gzip.open(os.path.join(self.result_dir.folder, name)) as f:
+                self.assertIn('Layout', json.load(f)['slices']['1:2'])
+
+    def test_each_trace_is_parsed_once(self):
+        # The workers are separate processes, they record the parsed traces in a file
+        parsed = os.path.join(self.directory, "parsed")
+
+        def parse(trace_file, *args):
+            with open(parsed, "a") as f:
+                f.write(os.path.basename(trace_file) + "\n")
+            return 0
+
+        with mock.patch.object(chrome_webdriver.trace_parser, "ParseTrace", side_effect=parse):
+            self.run_session(lambda run, step: json.dumps(TRACE))
+
+        with open(parsed) as f:
+            self.assertEqual(["1_2_trace.json", "1_trace.json", "2_2_trace.json", "2_trace.json"],
+                             sorted(f.read().split()))
+        self.assertEqual([], self.provider.pending)
+        self.assertIsNone(self.provider.pool)
+
+    def test_reports_failed_traces(self):
+        def parse(trace_file, *args):
+            if trace_file.endswith("2_2_trace.json"):
+                raise Exception("Failed")
+            return 0
+
+        with mock.patch.object(chrome_webdriver.trace_parser, "ParseTrace", side_effect=parse):
+            with self.assertRaises(RuntimeError) as cm:
+                self.run_session(lambda run, step: json.dumps(TRACE))
+
+        self.assertIn("2_2_trace.json", str(cm.exception))
+        self.assertNotIn("1_trace.json", str(cm.exception))
+        self.assertIsNone(self.provider.pool)
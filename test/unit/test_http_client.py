@@ -0,0 +1,133 @@
+import cgi
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from client.http_client import HttpClient, HttpError
+from client.log import init_log
+
+init_log(4)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = ""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if size == 0:
+                    break
+                body += chunk
+        else:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.respond(body)
+
+    def respond(self, body=None):
+        self.server.requests.append((self.command, self.path, self.headers, body, self.client_address))
+        response = self.server.responses.pop(0) if self.server.responses else (200, "OK")
+        self.send_response(response[0])
+        self.send_header("Content-Length", str(len(response[1])))
+        self.end_headers()
+        self.wfile.write(response[1])
+        if self.server.drop_connections:
+            # Close the connection without telling the client, like a server timing out an idle keep-alive
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(HTTPServer):
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.requests = []
+        self.responses = []
+        self.drop_connections = False
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/wpt" % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def parse_multipart(headers, body):
+    return cgi.FieldStorage(fp=io.BytesIO(body), headers=headers, environ={
+        'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': headers['Content-Type'], 'CONTENT_LENGTH': str(len(body))})
+
+
+class TestHttpClient(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_keeps_connection_alive(self):
+        self.server.responses = [(200, "a"), (200, "b"), (200, "c")]
+        client = HttpClient(self.server.url)
+
+        self.assertEqual(["a", "b", "c"], [client.get("work/getwork.php", {"location": "L"}) for i in range(3)])
+        self.assertEqual(1, client.connections_opened)
+        self.assertEqual(1, len(set(r[4] for r in self.server.requests)))
+        self.assertEqual("/wpt/work/getwork.php?location=L", self.server.requests[0][1])
+        client.close()
+
+    def test_reconnects_when_kept_alive_connection_was_closed(self):
+        self.server.drop_connections = True
+        client = HttpClient(self.server.url)
+
+        client.get("work/getwork.php")
+        client.get("work/getwork.php")
+
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual(2, client.connections_opened)
+
+    def test_raises_on_error_status(self):
+        self.server.responses = [(500, "")]
+        client = HttpClient(self.server.url)
+
+        with self.assertRaises(HttpError) as cm:
+            client.get("work/getwork.php")
+        self.assertEqual(500, cm.exception.status)
+
+    def test_streams_multipart_upload(self):
+        data = os.urandom(100 * 1024) + "a" * 200 * 1024
+        with open(os.path.join(self.directory, "trace.json"), "wb") as f:
+            f.write(data)
+        with open(os.path.join(self.directory, "frame.png"), "wb") as f:
+            f.write(data)
+
+        client = HttpClient(self.server.url)
+        client.upload("work/workdone.php", [("id", "1"), ("done", "1")],
+                      [("file", "trace.json", os.path.join(self.directory, "trace.json")),
+                       ("file", "frame.png", os.path.join(self.directory, "frame.png"))], compress=True)
+
+        method, path, headers, body, address = self.server.requests[0]
+        self.assertEqual("chunked", headers["Transfer-Encoding"])
+        form = parse_multipart(headers, body)
+        self.assertEqual("1", form.getfirst("id"))
+        self.assertEqual("1", form.getfirst("done"))
+        files = dict((f.filename, f.value) for f in form["file"])
+        self.assertEqual(["frame.png", "trace.json.gz"], sorted(files.keys()))
+        self.assertEqual(data, files["frame.png"])
+        self.assertEqual(data, gzip.GzipFile(fileobj=io.BytesIO(files["trace.json.gz"])).read())
+        self.assertTrue(len(files["trace.json.gz"]) < len(data))
@@ -0,0 +1,139 @@
+import gzip
+import imp
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+trace_parser = imp.load_source("trace_parser", os.path.join(os.path.dirname(__file__), "..", "..",
+                                                              "lib", "trace", "trace-parser.py"))
+
+
+def trace_events(count):
+    events = [{'cat': 'devtools.timeline', 'name': 'ResourceSendRequest', 'ph': 'X', 'pid': 1, 'tid': 2, 'ts': 1000,
+               'args': {'data': {'url': 'http://example.com/'}}}]
+    for i in range(count):
+        events.append({'cat': 'devtools.timeline', 'name': 'Layout' if i % 2 else 'Paint', 'ph': 'X', 'pid': 1,
+                       'tid': 2, 'ts': 1000 + i * 700, 'dur': 500 + i * 10})
+    events.append({'cat': 'blink.user_timing', 'name': 'mark', 'ph': 'R', 'pid': 1, 'tid': 2, 'ts': 5000})
+    return events
+
+
+class TestTraceReader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="tmp_trace_")
+        self.events = trace_events(50)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, data, chunk_size=7):
+        return list(trace_parser.TraceReader(io.BytesIO(data), chunk_size=chunk_size).Events())
+
+    def test_event_array(self):
+        data = "[\n" + ",\n".join(json.dumps(e) for e in self.events) + "\n]"
+        self.assertEqual(self.events, self.read(data))
+
+    def test_event_per_line(self):
+        data = "\n".join(json.dumps(e) for e in self.events) + "\n"
+        self.assertEqual(self.events, self.read(data))
+
+    def test_trace_events_object(self):
+        self.assertEqual(self.events, self.read(json.dumps({'traceEvents': self.events, 'metadata': {'a': 1}})))
+        self.assertEqual(self.events, self.read(json.dumps({'traceEvents': self.events}, indent=2)))
+
+    def test_trace_events_object_not_first_key(self):
+        data = '{"metadata": {"a": 1}, "traceEvents": %s}' % json.dumps(self.events)
+        self.assertEqual(self.events, self.read(data))
+
+    def test_skips_invalid_lines(self):
+        data = "[\n%s,\n{\"cat\": broken,\n%s\n]" % (json.dumps(self.events[0]), json.dumps(self.events[1]))
+        self.assertEqual(self.events[:2], self.read(data, chunk_size=1024))
+
+    def test_large_object_with_trace_events_not_first(self):
+        data = '{"metadata": {"name": "x", "ts": 1}, "traceEvents": %s, "more": [1, 2]}' % json.dumps(self.events)
+        events = list(trace_parser.TraceReader(io.BytesIO(data), chunk_size=64, max_event_size=256).Events())
+        self.assertEqual(self.events, events)
+
+    def test_skips_invalid_line_longer_than_buffer(self):
+        data = "[\n%s,\n{\"cat\": broken %s,\n%s\n]" % (json.dumps(self.events[0]), "x" * 1000,
+                                                         json.dumps(self.events[1]))
+        events = list(trace_parser.TraceReader(io.BytesIO(data), chunk_size=64, max_event_size=256).Events())
+        self.assertEqual(self.events[:2], events)
+
+    def test_truncated_trace(self):
+        data = "[\n" + ",\n".join(json.dumps(e) for e in self.events)
+        self.assertEqual(self.events[:-1], self.read(data[:-10]))
+
+    def test_process_layouts_match(self):
+        results = []
+        for name, data in [("trace.json", "[\n" + ",\n".join(json.dumps(e) for e in self.events) + "\n]"),
+                           ("trace.json.gz", json.dumps({'traceEvents': self.events}))]:
+            path = os.path.join(self.dir, name)
+            f = gzip.open(path, "wb") if name.endswith(".gz") else open(path, "wb")
+            f.write(data)
+            f.close()
+            trace = trace_parser.Trace()
+            trace.Process(path)
+            results.append((trace.cpu, trace.user_timing))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(1, len(results[0][1]))
+        self.assertIn('slices', results[0][0])
+
+
+class TestTimelineSlices(unittest.TestCase):
+    def create_trace(self, seed, names=3, threads=2):
+        rnd = random.Random(seed)
+        trace = trace_parser.Trace()
+        trace.start_time = 1000
+        for n in range(names):
+            trace.event_names['Event%d' % n] = n
+            trace.event_name_lookup[n] = 'Event%d' % n
+
+        def create_events(start, end, depth):
+            events = []
+            ts = start
+            while ts < end and len(events) < 5:
+                e = {'t': thread, 'n': rnd.randint(0, names - 1), 's': ts, 'e': min(end, ts + rnd.randint(0, 3000))}
+                trace.threads[thread]['Event%d' % e['n']] = e['n']
+                if depth < 4 and rnd.random() < 0.6:
+                    e['c'] = create_events(e['s'], e['e'] + rnd.randint(0, 2000), depth + 1)
+                events.append(e)
+                ts = e['e'] + rnd.randint(-500, 3000)
+            return events
+
+        for t in range(threads):
+            thread = '1:%d' % t
+            trace.threads[thread] = {}
+            trace.timeline_events.extend(create_events(trace.start_time, trace.start_time + 20000, 0))
+        trace.end_time = max(e['e'] for e in trace.timeline_events)
+        return trace
+
+    def python_slices(self, *args):
+        raise ImportError()
+
+    def test_array_slices_match_python(self):
+        for seed in range(20):
+            trace = self.create_trace(seed, names=1 + seed % 4)
+            trace.ProcessTimelineEvents()
+            array_cpu = json.dumps(trace.cpu, sort_keys=True)
+            trace.ProcessTimelineSlices = self.python_slices
+            trace.ProcessTimelineEvents()
+            self.assertEqual(json.dumps(trace.cpu, sort_keys=True), array_cpu)
+
+    def test_slices_are_capped(self):
+        trace = trace_parser.Trace()
+        trace.start_time = 0
+        trace.end_time = 10000000
+        trace.threads['1:1'] = {'A': 0, 'B': 1}
+        trace.event_name_lookup = {0: 'A', 1: 'B'}
+        trace.timeline_events = [{'t': '1:1', 'n': 0, 's': 0, 'e': 10000000},
+                                 {'t': '1:1', 'n': 1, 's': 0, 'e': 4000000}]
+        trace.ProcessTimelineEvents()
+        slices = trace.cpu['slices']['1:1']
+        self.assertEqual(1000, trace.cpu['slice_usecs'])
+        self.assertEqual([0] * 4000 + [1000] * 6000, slices['A'])
+        self.assertEqual([1000] * 4000 + [0] * 6000, slices['B'])
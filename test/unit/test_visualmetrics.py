@@ -0,0 +1,494 @@
+import argparse
+import imp
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import mock
+from PIL import Image
+
+visualmetrics = imp.load_source("visualmetrics", os.path.join(os.path.dirname(__file__), "..", "..",
+                                                               "lib", "video", "visualmetrics.py"))
+
+
+def write_frame(path, size=(64, 48), mode="RGB", seed=0, white_fraction=0.5):
+    rnd = random.Random(seed)
+    channels = len(mode)
+    im = Image.new(mode, size)
+    pixels = []
+    for i in range(size[0] * size[1]):
+        if rnd.random() < white_fraction:
+            pixels.append(tuple(rnd.randint(250, 255) for c in range(channels)))
+        else:
+            pixels.append(tuple(rnd.randint(0, 255) for c in range(channels)))
+    im.putdata(pixels)
+    im.save(path)
+    return path
+
+
+class TestImageHistogram(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="tmp_vm_")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_array_histogram_matches_python(self):
+        for seed in range(3):
+            frame = write_frame(os.path.join(self.dir, "frame-%d.png" % seed), seed=seed)
+            self.assertEqual(visualmetrics.calculate_image_histogram_python(frame),
+                             visualmetrics.calculate_image_histogram(frame))
+
+    def test_array_histogram_ignores_alpha(self):
+        frame = write_frame(os.path.join(self.dir, "frame.png"), mode="RGBA")
+        self.assertEqual(visualmetrics.calculate_image_histogram_python(frame),
+                         visualmetrics.calculate_image_histogram(frame))
+
+    def test_white_frame_is_empty(self):
+        frame = os.path.join(self.dir, "white.png")
+        Image.new("RGB", (32, 32), (255, 255, 255)).save(frame)
+        histogram = visualmetrics.calculate_image_histogram(frame)
+        self.assertEqual(0, sum(histogram['r']) + sum(histogram['g']) + sum(histogram['b']))
+
+    def test_other_modes_fall_back(self):
+        frame = os.path.join(self.dir, "gray.png")
+        Image.new("L", (8, 8), 10).save(frame)
+        self.assertIsNone(visualmetrics.load_image_array(frame))
+        self.assertEqual(visualmetrics.calculate_image_histogram_python(frame),
+                         visualmetrics.calculate_image_histogram(frame))
+
+
+def has_imagemagick():
+    return visualmetrics.check_process('compare -version', 'ImageMagick')
+
+
+def frame_options(**kwargs):
+    defaults = dict(compare='native', viewport=False, notification=False, findstart=0, renderignore=0,
+                    forceblank=False, histogram=None, cachesize=256)
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+class TestFrameDiff(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="tmp_vm_")
+        visualmetrics.options = frame_options()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        visualmetrics.options = None
+
+    def frame(self, name, color=(255, 255, 255), rects=()):
+        im = Image.new("RGB", (100, 80), color)
+        for rect, rect_color in rects:
+            im.paste(rect_color, rect)
+        path = os.path.join(self.dir, name)
+        im.save(path)
+        return path
+
+    def test_identical_frames(self):
+        a = self.frame("a.png")
+        b = self.frame("b.png")
+        self.assertEqual(0, visualmetrics.count_different_pixels(a, b, 0, None, None))
+        self.assertTrue(visualmetrics.frames_match(a, b, 0, 0, None, None))
+
+    def test_fuzz(self):
+        a = self.frame("a.png", color=(200, 200, 200))
+        b = self.frame("b.png", color=(200, 200, 200), rects=[((0, 0, 10, 10), (210, 200, 200)),
+                                                              ((50, 50, 60, 60), (240, 200, 200))])
+        self.assertEqual(200, visualmetrics.count_different_pixels(a, b, 0, None, None))
+        # 10 units is within 5% (12.75), 40 units is not
+        self.assertEqual(100, visualmetrics.count_different_pixels(a, b, 5, None, None))
+        self.assertEqual(0, visualmetrics.count_different_pixels(a, b, 20, None, None))
+
+    def test_crop(self):
+        a = self.frame("a.png")
+        b = self.frame("b.png", rects=[((0, 0, 10, 10), (0, 0, 0)), ((90, 70, 100, 80), (0, 0, 0))])
+        self.assertEqual(200, visualmetrics.count_different_pixels(a, b, 0, None, None))
+        self.assertEqual(100, visualmetrics.count_different_pixels(a, b, 0, "50x40+0+0", None))
+        self.assertEqual(100, visualmetrics.count_different_pixels(a, b, 0, "500x400+50+40", None))
+
+    def test_mask(self):
+        a = self.frame("a.png")
+        b = self.frame("b.png", rects=[((40, 30, 60, 50), (0, 0, 0)), ((0, 0, 10, 10), (0, 0, 0))])
+        mask = {'x': 35, 'y': 25, 'width': 30, 'height': 30}
+        self.assertEqual(100, visualmetrics.count_different_pixels(a, b, 0, None, mask))
+        self.assertEqual(0, visualmetrics.count_different_pixels(a, b, 0, "50x40+50+0", mask))
+
+    def test_size_mismatch_does_not_match(self):
+        a = self.frame("a.png")
+        b = os.path.join(self.dir, "b.png")
+        Image.new("RGB", (50, 50), (255, 255, 255)).save(b)
+        self.assertIsNone(visualmetrics.count_different_pixels(a, b, 0, None, None))
+        self.assertFalse(visualmetrics.frames_match(a, b, 0, 0, None, None))
+
+
+class TestFrameDiffFixture(unittest.TestCase):
+    # Expected "compare -metric AE" counts for frames that only differ by a lot (at least 120 units per channel) or
+    # by a little (at most 2 units), so the counts don't depend on the details of how ImageMagick applies the fuzz.
+    # The native comparison always runs against them, ImageMagick does when it is installed.
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="tmp_vm_")
+        with open(os.path.join(os.path.dirname(__file__), "fixtures", "frame_diff.json")) as f:
+            self.cases = json.load(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def frames(self, case):
+        a = os.path.join(self.dir, "a.png")
+        b = os.path.join(self.dir, "b.png")
+        Image.new("RGB", (100, 80), tuple(case['base'])).save(a)
+        im = Image.new("RGB", (100, 80), tuple(case['base']))
+        for x0, y0, x1, y1, color in case['rects']:
+            im.paste(tuple(color), (x0, y0, x1, y1))
+        im.save(b)
+        return a, b
+
+    def check(self, count_different_pixels):
+        for case in self.cases:
+            a, b = self.frames(case)
+            self.assertEqual(case['expected'], count_different_pixels(a, b, case['fuzz'], case['crop'], case['mask']),
+                             case)
+
+    def test_native_counts(self):
+        self.check(visualmetrics.count_different_pixels)
+
+    @unittest.skipUnless(has_imagemagick(), "ImageMagick is not installed")
+    def test_imagemagick_counts(self):
+        self.check(visualmetrics.count_different_pixels_imagemagick)
+
+
+@unittest.skipUnless(has_imagemagick(), "ImageMagick is not installed")
+class TestFrameDiffParity(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="tmp_vm_")
+        rnd = random.Random(1)
+        # A page that renders in a few steps, with noise and repeated frames in between
+        im = Image.new("RGB", (120, 90), (255, 255, 255))
+        for i in range(12):
+            if i in (3, 6, 9):
+                im.paste((rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+                         (rnd.randint(0, 80), rnd.randint(0, 60), 110, 85))
+            noisy = im.copy()
+            for n in range(i % 4):
+                x, y = rnd.randint(0, 119), rnd.randint(0, 89)
+                p = noisy.getpixel((x, y))
+                noisy.putpixel((x, y), tuple(max(0, c - rnd.randint(0, 40)) for c in p))
+            noisy.save(os.path.join(self.dir, "ms_{0:06d}.png".format(i * 100)))
+            noisy.save(os.path.join(self.dir, "video-{0:06d}.png".format(i * 100)))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        visualmetrics.options = None
+
+    def run_stage(self, stage, compare, **kwargs):
+        directory = os.path.join(self.dir, compare)
+        shutil.copytree(self.dir, directory, ignore=shutil.ignore_patterns("native", "imagemagick"))
+        visualmetrics.options = frame_options(compare=compare, **kwargs)
+        stage(directory)
+        return sorted(os.listdir(directory))
+
+    def assertParity(self, stage, **kwargs):
+        self.assertEqual(self.run_stage(stage, 'imagemagick', **kwargs), self.run_stage(stage, 'native', **kwargs))
+
+    def test_counts(self):
+        frames = sorted(f for f in os.listdir(self.dir) if f.startswith("ms_"))
+        for fuzz in (0, 1, 5, 10):
+            for crop in (None, "100x80+0+3"):
+                for i in range(1, len(frames)):
+                    a, b = os.path.join(self.dir, frames[0]), os.path.join(self.dir, frames[i])
+                    self.assertEqual(visualmetrics.count_different_pixels_imagemagick(a, b, fuzz, crop, None),
+                                     visualmetrics.count_different_pixels(a, b, fuzz, crop, None))
+
+    def test_eliminate_duplicate_frames(self):
+        self.assertParity(visualmetrics.eliminate_duplicate_frames)
+
+    def test_eliminate_similar_frames(self):
+        self.assertParity(visualmetrics.eliminate_similar_frames, notification=True)
+
+    def test_find_first_frame(self):
+        self.assertParity(visualmetrics.find_first_frame, findstart=10)
+
+    def test_find_render_start(self):
+        self.assertParity(visualmetrics.find_render_start, renderignore=20)
+
+
+class TestFrameCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="tmp_vm_")
+        self.frames = [write_frame(os.path.join(self.dir, "video-%06d.png" % i), size=(20, 10), seed=i)
+                       for i in range(3)]
+        visualmetrics.frame_cache = visualmetrics.FrameCache(20 * 10 * 3 * 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        visualmetrics.frame_cache = None
+
+    def test_decodes_once(self):
+        cache = visualmetrics.frame_cache
+        first = visualmetrics.load_image_array(self.frames[0])
+        self.assertIs(first, visualmetrics.load_image_array(self.frames[0]))
+        self.assertEqual((20, 10), visualmetrics.get_frame_size(self.frames[0]))
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+
+    def test_evicts_least_recently_used(self):
+        cache = visualmetrics.frame_cache
+        for frame in self.frames:
+            visualmetrics.load_image_array(frame)
+        self.assertEqual(self.frames[1:], list(cache.frames.keys()))
+        self.assertEqual(cache.max_bytes, cache.bytes)
+
+    def test_reloads_changed_frame(self):
+        cache = visualmetrics.frame_cache
+        visualmetrics.load_image_array(self.frames[0])
+        Image.new("RGB", (20, 10), (255, 255, 255)).save(self.frames[0])
+        pixels = visualmetrics.load_image_array(self.frames[0])
+        self.assertEqual(255, pixels.min())
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+    def test_follows_moved_and_removed_frames(self):
+        cache = visualmetrics.frame_cache
+        visualmetrics.load_image_array(self.frames[0])
+        dest = os.path.join(self.dir, "ms_000000.png")
+        visualmetrics.move_frame(self.frames[0], dest)
+        visualmetrics.load_image_array(dest)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        visualmetrics.remove_frame(dest)
+        self.assertEqual(0, cache.bytes)
+        self.assertFalse(os.path.exists(dest))
+
+
+class TestOrangeFrames(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="tmp_vm_")
+        self.orange_file = os.path.join(self.dir, "orange.png")
+        visualmetrics.generate_orange_png(self.orange_file)
+        visualmetrics.options = frame_options()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        visualmetrics.options = None
+
+    def frame(self, time, color, size=(160, 120)):
+        im = Image.new("RGB", size, color)
+        # Browser UI around the overlay doesn't affect the center of the frame
+        im.paste((40, 40, 40), (0, 0, size[0], 10))
+        path = os.path.join(self.dir, "video-{0:06d}.png".format(time))
+        im.save(path)
+        return path
+
+    def test_classification(self):
+        orange = self.frame(0, (222, 100, 13))
+        noisy = self.frame(10, (225, 98, 15))
+        white = self.frame(20, (255, 255, 255))
+        self.assertEqual([True, True, False],
+                         visualmetrics.find_orange_frames([orange, noisy, white], self.orange_file))
+
+    def test_frames_are_classified_once(self):
+        calls = []
+        classify = visualmetrics.is_orange_frame_native
+
+        def counting_classify(file, orange_file):
+            calls.append(file)
+            return classify(file, orange_file)
+
+        visualmetrics.is_orange_frame_native = counting_classify
+        try:
+            frames = [self.frame(t, (222, 100, 13) if t < 30 else (10, 200, 10)) for t in range(0, 100, 10)]
+            orange = visualmetrics.find_orange_frames(frames, self.orange_file)
+            kept, orange = visualmetrics.remove_frames_before_orange(frames, orange)
+            kept, orange = visualmetrics.remove_orange_frames(kept, orange)
+        finally:
+            visualmetrics.is_orange_frame_native = classify
+        self.assertEqual(frames, calls)
+        self.assertEqual(frames[3:], kept)
+        self.assertEqual([False] * 7, orange)
+        self.assertEqual([os.path.basename(f) for f in frames[3:]],
+                         sorted(f for f in os.listdir(self.dir) if f.startswith("video-")))
+
+    def test_frames_before_orange(self):
+        frames = [self.frame(0, (255, 255, 255)), self.frame(10, (222, 100, 13)), self.frame(20, (10, 200, 10)),
+                  self.frame(30, (222, 100, 13))]
+        orange = visualmetrics.find_orange_frames(frames, self.orange_file)
+        self.assertEqual([False, True, False, True], orange)
+        kept, orange = visualmetrics.remove_frames_before_orange(frames, orange)
+        self.assertEqual((frames[1:], [True, False, True]), (kept, orange))
+        self.assertEqual((frames[2:3], [False]), visualmetrics.remove_orange_frames(kept, orange))
+        self.assertEqual(["orange.png", "video-000020.png"], sorted(os.listdir(self.dir)))
+
+    def test_split_videos(self):
+        self.frame(0, (255, 255, 255))
+        self.frame(10, (222, 100, 13))
+        self.frame(20, (10, 10, 200))
+        self.frame(30, (222, 100, 13))
+        self.frame(40, (222, 100, 13))
+        self.frame(50, (200, 10, 10))
+        directories, classified = visualmetrics.split_videos(self.dir, self.orange_file)
+        self.assertEqual(2, len(directories))
+        self.assertEqual(["video-000010.png", "video-000020.png", "video-000030.png"],
+                         sorted(os.listdir(directories[0])))
+        self.assertEqual(["video-000030.png", "video-000040.png", "video-000050.png"],
+                         sorted(os.listdir(directories[1])))
+        for directory in directories:
+            frames = visualmetrics.list_frames(directory, "video-*.png")
+            self.assertEqual(set(frames), set(f for f in classified if os.path.dirname(f) == directory))
+            visualmetrics.remove_orange_frames(frames, [classified[f] for f in frames])
+        self.assertEqual(["video-000020.png"], sorted(os.listdir(directories[0])))
+        self.assertEqual(["video-000050.png"], sorted(os.listdir(directories[1])))
+
+
+def has_ffmpeg():
+    return visualmetrics.check_process('ffmpeg -version', 'ffmpeg')
+
+
+class TestMemoryFrames(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="tmp_vm_")
+        visualmetrics.options = frame_options()
+        visualmetrics.memory_frames = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        visualmetrics.options = None
+        visualmetrics.memory_frames = {}
+        visualmetrics.frame_histograms = {}
+
+    def make_frames(self, directory, in_memory):
+        os.mkdir(directory)
+        colors = [(255, 255, 255)] * 3 + [(200, 10, 10)] * 2 + [(10, 10, 200)] * 3
+        for i, color in enumerate(colors):
+            im = Image.new("RGB", (60, 40), (255, 255, 255))
+            im.paste(color, (0, 0, 30, 20 + i))
+            path = os.path.join(directory, "video-{0:06d}.png".format(1000 + i * 100))
+            if in_memory:
+                visualmetrics.memory_frames[path] = visualmetrics.decode_pil_array(im)
+            else:
+                im.save(path)
+
+    def process(self, directory):
+        visualmetrics.adjust_frame_times(directory)
+        visualmetrics.eliminate_duplicate_frames(directory)
+        visualmetrics.write_memory_frames(directory)
+        frames = sorted(os.listdir(directory))
+        return frames, [visualmetrics.calculate_image_histogram(os.path.join(directory, f)) for f in frames]
+
+    def test_frame_helpers(self):
+        path = os.path.join(self.dir, "video-000000.png")
+        visualmetrics.memory_frames[path] = visualmetrics.decode_pil_array(Image.new("RGB", (4, 2)))
+        self.assertEqual([path], visualmetrics.list_frames(self.dir, "video-*.png"))
+        self.assertEqual((4, 2), visualmetrics.get_frame_size(path))
+        dest = os.path.join(self.dir, "ms_000000.png")
+        visualmetrics.move_frame(path, dest)
+        visualmetrics.copy_frame(dest, path)
+        self.assertEqual([dest, path], visualmetrics.list_frames(self.dir, "*.png"))
+        visualmetrics.remove_frame(path)
+        self.assertEqual([], os.listdir(self.dir))
+        visualmetrics.write_memory_frames(self.dir)
+        self.assertEqual(["ms_000000.png"], os.listdir(self.dir))
+        self.assertEqual({}, visualmetrics.memory_frames)
+
+    def test_memory_frames_match_disk_frames(self):
+        disk = os.path.join(self.dir, "disk")
+        memory = os.path.join(self.dir, "memory")
+        self.make_frames(disk, False)
+        self.make_frames(memory, True)
+        self.assertEqual([], os.listdir(memory))
+        frames, histograms = self.process(memory)
+        self.assertEqual((frames, histograms), self.process(disk))
+        self.assertEqual(["ms_000000.png", "ms_000300.png", "ms_000400.png", "ms_000500.png", "ms_000600.png",
+                         "ms_000700.png"],
+                         frames)
+
+    def test_histograms_calculated_from_memory(self):
+        visualmetrics.options = frame_options(histogram="histograms.json.gz")
+        directory = os.path.join(self.dir, "frames")
+        self.make_frames(directory, True)
+        visualmetrics.write_memory_frames(directory)
+        frames = [os.path.join(directory, f) for f in sorted(os.listdir(directory))]
+        self.assertEqual(sorted(frames), sorted(visualmetrics.frame_histograms.keys()))
+        expected = [visualmetrics.calculate_image_histogram_python(f) for f in frames]
+        with mock.patch.object(visualmetrics, "load_image_array") as load:
+            self.assertEqual(expected[:-1], [visualmetrics.calculate_image_histogram(f) for f in frames[:-1]])
+            self.assertFalse(load.called)
+
+        # A frame rewritten after it was saved is not served a stale histogram
+        Image.new("RGB", (60, 40), (0, 0, 0)).save(frames[-1])
+        os.utime(frames[-1], (0, 0))
+        self.assertEqual(visualmetrics.calculate_image_histogram_python(frames[-1]),
+                         visualmetrics.calculate_image_histogram(frames[-1]))
+
+    def make_video(self):
+        video = os.path.join(self.dir, "video.mp4")
+        visualmetrics.subprocess.check_call(
+            "ffmpeg -v error -f lavfi -i \"color=c=white:s=160x120:d=2:r=30,drawbox=w=50:h=50:color=red:t=fill:"
+            "enable='gte(t,1)'\" -pix_fmt yuv420p \"%s\"" % video, shell=True)
+        return video
+
+    @unittest.skipUnless(has_ffmpeg(), "ffmpeg is not installed")
+    def test_extract_frames_stream_spills_to_disk(self):
+        video = self.make_video()
+        disk = os.path.join(self.dir, "disk")
+        memory = os.path.join(self.dir, "memory")
+        os.mkdir(disk)
+        os.mkdir(memory)
+        self.assertTrue(visualmetrics.extract_frames(video, disk, False, None))
+        visualmetrics.options = frame_options(cachesize=1)
+        self.assertTrue(visualmetrics.extract_frames_stream(video, memory, False, None))
+        self.assertLessEqual(visualmetrics.memory_frame_bytes(), 1024 * 1024)
+        self.assertNotEqual([], os.listdir(memory))
+        self.assertEqual(sorted(os.listdir(disk)),
+                         [os.path.basename(f) for f in visualmetrics.list_frames(memory, "video-*.png")])
+        for frame in os.listdir(disk):
+            self.assertEqual(visualmetrics.calculate_image_histogram(os.path.join(disk, frame)),
+                             visualmetrics.calculate_image_histogram(os.path.join(memory, frame)))
+
+    @unittest.skipUnless(has_ffmpeg(), "ffmpeg is not installed")
+    def test_extract_frames_stream(self):
+        video = self.make_video()
+        disk = os.path.join(self.dir, "disk")
+        memory = os.path.join(self.dir, "memory")
+        os.mkdir(disk)
+        os.mkdir(memory)
+        self.assertTrue(visualmetrics.extract_frames(video, disk, False, None))
+        self.assertTrue(visualmetrics.extract_frames_stream(video, memory, False, None))
+        self.assertEqual([], os.listdir(memory))
+        self.assertEqual(sorted(os.listdir(disk)),
+                         sorted(os.path.basename(f) for f in visualmetrics.memory_frames))
+        for frame in os.listdir(disk):
+            self.assertEqual(visualmetrics.calculate_image_histogram(os.path.join(disk, frame)),
+                             visualmetrics.calculate_image_histogram(os.path.join(memory, frame)))
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+class TestVisualProgress(unittest.TestCase):
+    def setUp(self):
+        self.histograms_file = os.path.join(FIXTURES, "histograms.json.gz")
+        with open(os.path.join(FIXTURES, "histograms.expected.json")) as f:
+            self.expected = json.load(f)
+
+    def test_metrics_match_recorded_values(self):
+        for expected in self.expected:
+            self.assertEqual(expected['metrics'],
+                             visualmetrics.calculate_visual_metrics(self.histograms_file, expected['start'],
+                                                                    expected['end'], False, None))
+            histograms = visualmetrics.load_histograms(self.histograms_file, expected['start'], expected['end'])
+            progress = visualmetrics.calculate_visual_progress(histograms)
+            self.assertEqual(expected['visually_complete'], visualmetrics.find_visually_complete(progress))
+
+    def test_array_progress_matches_python(self):
+        for expected in self.expected:
+            histograms = visualmetrics.load_histograms(self.histograms_file, expected['start'], expected['end'])
+            self.assertEqual(visualmetrics.calculate_visual_progress_python(histograms),
+                             visualmetrics.calculate_progress_array(visualmetrics.histograms_to_array(histograms)))
+
+    def test_unchanged_frames_are_complete(self):
+        histogram = {'r': [1] * 256, 'g': [2] * 256, 'b': [3] * 256}
+        histograms = [{'time': 0, 'histogram': histogram}, {'time': 100, 'histogram': histogram}]
+        self.assertEqual([100, 100], visualmetrics.calculate_progress_array(
+            visualmetrics.histograms_to_array(histograms)))
@@ -0,0 +1,82 @@
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from client.log import init_log
+from client.model import ResultDirectory, Run, Session, Step, View
+from client.provider import EventDispatcher, Event
+from client.video.visualmetrics import VisualMetrics
+
+init_log(4)
+
+
+class TestVisualMetricsProvider(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.result_dir = ResultDirectory(self.directory + "/result")
+        self.session = Session(2, self.result_dir)
+        for r in range(1, 3):
+            run = Run(r)
+            view = View(True, False)
+            step = Step(1, "Step 1")
+            view.add_step(step)
+            run.add_view(view)
+            self.session.add_run(run)
+            self.result_dir.get_file("video.mp4", run, view, step)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_provider(self, concurrency):
+        provider = VisualMetrics(EventDispatcher(), {'lockfile': None, 'concurrency': concurrency})
+        provider.session = self.session
+        return provider
+
+    def test_processes_videos_concurrently(self):
+        lock = threading.Lock()
+        all_started = threading.Event()
+        commands = []
+
+        def run(cmd, **kwargs):
+            with lock:
+                commands.append(cmd)
+                if len(commands) == 2:
+                    all_started.set()
+            # Both videos must be in flight at the same time to get past this point
+            if not all_started.wait(5):
+                raise Exception("Videos were not processed concurrently")
+
+        with mock.patch("client.process.run", side_effect=run):
+            self.create_provider(2).on_stop_session(Event("StopSession"))
+
+        self.assertEqual(2, len(commands))
+
+    def test_reports_failed_videos(self):
+        def run(cmd, **kwargs):
+            if cmd[cmd.index("-i") + 1].endswith("1_video.mp4"):
+                raise Exception("Failed")
+
+        provider = self.create_provider(2)
+        provider.unlock = mock.Mock()
+        with mock.patch("client.process.run", side_effect=run) as run_mock:
+            with self.assertRaises(RuntimeError) as cm:
+                provider.on_stop_session(Event("StopSession"))
+
+        self.assertEqual(2, run_mock.call_count)
+        self.assertIn("1_video.mp4", str(cm.exception))
+        self.assertNotIn("2_video.mp4", str(cm.exception))
+        self.assertTrue(provider.unlock.called)
+
+
+    def test_lock_released_before_processing(self):
+        calls = []
+        provider = self.create_provider(2)
+        provider.lock = mock.Mock(side_effect=lambda *args: calls.append("lock"))
+        provider.unlock = mock.Mock(side_effect=lambda *args: calls.append("unlock"))
+        with mock.patch("client.process.run", side_effect=lambda cmd, **kwargs: calls.append("run")):
+            provider.on_stop_session(Event("StopSession"))
+
+        self.assertEqual(["lock", "unlock", "run", "run"], calls[:4])
@@ -8,7 +8,7 @@ from client.log import init_log
 import argparse
 
 #
-# wpt_agent.py [-h] [-v] [--cmd CMD] url location
+# wpt_agent.py [-h] [-v] [--cmd CMD] [--slots N] [--work-dir DIR] [--max-poll-interval S] [--hold S] url location
 #
 
 logger = logging.getLogger("wpt_agent")
@@ -18,16 +18,26 @@ parser.add_argument('-v', '--verbose', action='count',
                     help="Increase verbosity (specify multiple times for more). -vvvv for full debug output.")
 parser.add_argument('url', help="base url")
 parser.add_argument('location', help="location name")
-parser.add_argument('--cmd')
+parser.add_argument('--cmd', help="Command to run a job with, {slot} and {lockfile} are replaced with the slot "
+                                   "number and the lock file of the slot the job runs in")
+parser.add_argument('--slots', type=int, default=1, help="Number of jobs to run concurrently")
+parser.add_argument('--work-dir', dest='work_dir', help="Directory for the result directories and lock files of the "
+                                                        "slots")
+parser.add_argument('--max-poll-interval', dest='max_poll_interval', type=int, default=60,
+                    help="Longest time in seconds to wait between polls while there is no work")
+parser.add_argument('--hold', type=int, default=0,
+                    help="Ask the server to hold polls for up to this many seconds until a job is available")
 options = parser.parse_args()
 
 init_log(options.verbose, "client.agent", "wpt_agent")
 
 
-def job(test_id, result_dir):
-    cmd = "%s %s %s/%s" % (options.cmd, result_dir, result_dir, "test.job")
+def job(test_id, result_dir, slot):
+    cmd = "%s %s %s/%s" % (options.cmd.format(slot=slot.index, lockfile=slot.lockfile), result_dir.folder,
+                           result_dir.folder, "test.job")
     logger.info("Executing cmd '%s'" % cmd)
     run(cmd)
 
-agent = Agent(options.url, options.location, job)
+agent = Agent(options.url, options.location, job, slots=options.slots, work_dir=options.work_dir,
+              max_poll_interval=options.max_poll_interval, hold=options.hold)
 agent.start()